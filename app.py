@@ -1,330 +1,1319 @@
-from flask import Flask, render_template, request, redirect, session, flash, send_file, url_for
-import sqlite3, os, pandas as pd
-from werkzeug.utils import secure_filename
-from datetime import datetime
-
-app = Flask(__name__)
-app.secret_key = 'voting_secret'
-
-UPLOAD_FOLDER = 'static/uploads'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
-def allowed_file(fname):
-    return '.' in fname and fname.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-def init_db():
-    conn = sqlite3.connect('voting.db')
-    c = conn.cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      username TEXT UNIQUE,
-      password TEXT,
-      name TEXT,
-      dob TEXT,
-      citizenship_id TEXT,
-      citizenship_photo TEXT,
-      personal_photo TEXT,
-      verified INTEGER DEFAULT 0,
-      role TEXT DEFAULT 'user'
-    )""")
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS elections (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      title TEXT,
-      start_date TEXT,
-      end_date TEXT
-    )""")
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS candidates (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      name TEXT,
-      party TEXT,
-      election_id INTEGER,
-      FOREIGN KEY(election_id) REFERENCES elections(id)
-    )""")
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS votes (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      user_id INTEGER,
-      candidate_id INTEGER,
-      election_id INTEGER
-    )""")
-    c.execute("INSERT OR IGNORE INTO users(username,password,role,verified) VALUES('admin','admin123','admin',1)")
-    conn.commit()
-    conn.close()
-
-@app.route('/')
-def home():
-    return render_template('home.html')
-
-@app.route('/register', methods=['GET','POST'])
-def register():
-    if request.method == 'POST':
-        u = request.form['username']
-        p = request.form['password']
-        name = request.form['name']
-        dob = request.form['dob']
-        cid = request.form['citizenship_id']
-        cit = request.files.get('citizenship_photo')
-        per = request.files.get('personal_photo')
-
-        if not (cit and per and allowed_file(cit.filename) and allowed_file(per.filename)):
-            flash("Please upload two valid image files.")
-            return redirect('/register')
-
-        cit_name = secure_filename(f"cit_{u}_{cit.filename}")
-        per_name = secure_filename(f"per_{u}_{per.filename}")
-        cit.save(os.path.join(UPLOAD_FOLDER, cit_name))
-        per.save(os.path.join(UPLOAD_FOLDER, per_name))
-
-        try:
-            conn = sqlite3.connect('voting.db')
-            conn.execute("""
-            INSERT INTO users(username,password,name,dob,citizenship_id,citizenship_photo,personal_photo)
-            VALUES(?,?,?,?,?,?,?)""",
-                         (u,p,name,dob,cid,cit_name,per_name))
-            conn.commit()
-            flash("Registered! Await admin approval.")
-            return redirect('/login')
-        except sqlite3.IntegrityError:
-            flash("Username already exists.")
-        finally:
-            conn.close()
-    return render_template('register.html')
-
-@app.route('/login', methods=['GET','POST'])
-def login():
-    if request.method=='POST':
-        u = request.form['username']
-        p = request.form['password']
-        conn = sqlite3.connect('voting.db')
-        user = conn.execute("SELECT * FROM users WHERE username=? AND password=?", (u,p)).fetchone()
-        conn.close()
-        if not user:
-            flash("Invalid credentials.")
-            return redirect('/login')
-
-        (uid, uname, pwd, name, dob, cid, cit_photo,
-         per_photo, verified, role) = user
-
-        if role != 'admin' and verified == 0:
-            flash("Awaiting admin approval.")
-            return redirect('/login')
-
-        session['user_id'] = uid
-        session['username'] = uname
-        session['role'] = role
-        session['logged_in'] = True
-        return redirect('/dashboard')
-    return render_template('login.html')
-
-@app.route('/dashboard')
-def dashboard():
-    if 'role' not in session:
-        return redirect('/login')
-    return redirect('/admin') if session['role']=='admin' else redirect('/user')
-
-@app.route('/admin')
-def admin_dashboard():
-    if session.get('role')!='admin':
-        return redirect('/login')
-    return render_template('admin_dashboard.html')
-
-@app.route('/admin/manage_election', methods=['GET', 'POST'])
-def manage_election():
-    if session.get('role') != 'admin':
-        return redirect(url_for('login'))
-
-    conn = sqlite3.connect('voting.db')
-    cursor = conn.cursor()
-
-    # Handle creating a new election
-    if request.method == 'POST' and 'create_election' in request.form:
-        title = request.form['title']
-        start_date = request.form['start_date']
-        end_date = request.form['end_date']
-        cursor.execute("INSERT INTO elections(title, start_date, end_date) VALUES (?, ?, ?)",
-                       (title, start_date, end_date))
-        conn.commit()
-        flash("Election created.")
-
-    # Handle adding a candidate
-    if request.method == 'POST' and 'add_candidate' in request.form:
-        name = request.form['candidate_name']
-        party = request.form['party']
-        election_id = request.form['election_id']
-        cursor.execute("INSERT INTO candidates(name, party, election_id) VALUES (?, ?, ?)",
-                       (name, party, election_id))
-        conn.commit()
-        flash("Candidate added.")
-
-    # Fetch elections and candidates
-    cursor.execute("SELECT * FROM elections")
-    elections = cursor.fetchall()
-
-    cursor.execute("""
-        SELECT c.id, c.name, c.party, c.election_id, e.title
-        FROM candidates c
-        LEFT JOIN elections e ON c.election_id = e.id
-    """)
-    candidates = cursor.fetchall()
-
-    conn.close()
-
-    return render_template('manage_election.html', elections=elections, candidates=candidates)
-
-@app.route('/admin/delete_election/<int:election_id>', methods=['POST'])
-def delete_election(election_id):
-    if session.get('role') != 'admin':
-        return redirect(url_for('login'))
-    conn = sqlite3.connect('voting.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM candidates WHERE election_id=?", (election_id,))
-    cursor.execute("DELETE FROM votes WHERE election_id=?", (election_id,))
-    cursor.execute("DELETE FROM elections WHERE id=?", (election_id,))
-    conn.commit()
-    conn.close()
-    flash("Election and related data deleted.")
-    return redirect(url_for('manage_election'))
-
-@app.route('/admin/delete_candidate/<int:candidate_id>', methods=['POST'])
-def delete_candidate(candidate_id):
-    if session.get('role') != 'admin':
-        return redirect(url_for('login'))
-    conn = sqlite3.connect('voting.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM votes WHERE candidate_id=?", (candidate_id,))
-    cursor.execute("DELETE FROM candidates WHERE id=?", (candidate_id,))
-    conn.commit()
-    conn.close()
-    flash("Candidate deleted.")
-    return redirect(url_for('manage_election'))
-
-@app.route('/admin/verify_users')
-def verify_users():
-    if session.get('role') != 'admin':
-        return redirect('/login')
-    conn = sqlite3.connect('voting.db')
-    users = conn.execute("""
-        SELECT id, username, name, dob, citizenship_id, citizenship_photo, personal_photo, verified
-        FROM users
-        WHERE role='user'
-    """).fetchall()
-    conn.close()
-    return render_template('verify_users.html', users=users)
-
-@app.route('/admin/approve_user/<int:user_id>')
-def approve_user(user_id):
-    if session.get('role')!='admin':
-        return redirect('/login')
-    conn = sqlite3.connect('voting.db')
-    conn.execute("UPDATE users SET verified=1 WHERE id=?", (user_id,))
-    conn.commit()
-    conn.close()
-    flash("User approved.")
-    return redirect('/admin/verify_users')
-
-@app.route('/delete_user/<int:user_id>', methods=['POST'])
-def delete_user(user_id):
-    conn = sqlite3.connect('voting.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE id=?", (user_id,))
-    conn.commit()
-    conn.close()
-    flash("User deleted successfully.")
-    return redirect(url_for('verify_users'))
-
-
-@app.route('/user')
-def user_dashboard():
-    if session.get('role') != 'user':
-        return redirect('/login')
-
-    now = datetime.now().isoformat()
-
-    conn = sqlite3.connect('voting.db')
-    cursor = conn.cursor()
-
-    ongoing = cursor.execute("SELECT * FROM elections WHERE start_date <= ? AND end_date >= ?", (now, now)).fetchall()
-    expired = cursor.execute("SELECT * FROM elections WHERE end_date < ?", (now,)).fetchall()
-    future = cursor.execute("SELECT * FROM elections WHERE start_date > ?", (now,)).fetchall()
-
-    voted = cursor.execute("SELECT election_id FROM votes WHERE user_id = ?", (session['user_id'],)).fetchall()
-    voted_ids = {v[0] for v in voted}
-
-    conn.close()
-    return render_template('user_dashboard.html', ongoing=ongoing, expired=expired, future=future, voted=voted_ids)
-
-
-
-@app.route('/vote/<int:election_id>', methods=['GET','POST'])
-def vote(election_id):
-    if session.get('role')!='user':
-        return redirect('/login')
-    conn = sqlite3.connect('voting.db')
-    verified = conn.execute("SELECT verified FROM users WHERE id=?", (session['user_id'],)).fetchone()[0]
-    if verified == 0:
-        conn.close()
-        flash("Awaiting admin approval.")
-        return redirect('/user')
-    now = datetime.now().isoformat()
-    election = conn.execute("SELECT * FROM elections WHERE id=?", (election_id,)).fetchone()
-    if not (election[2] <= now <= election[3]):
-        conn.close()
-        flash("Election not active.")
-        return redirect('/user')
-    if conn.execute("SELECT * FROM votes WHERE user_id=? AND election_id=?", (session['user_id'], election_id)).fetchone():
-        conn.close()
-        flash("Already voted.")
-        return redirect('/user')
-    candidates = conn.execute("SELECT * FROM candidates WHERE election_id=?", (election_id,)).fetchall()
-    if request.method=='POST':
-        cid = request.form['candidate']
-        conn.execute("INSERT INTO votes(user_id,candidate_id,election_id) VALUES(?,?,?)",
-                     (session['user_id'], cid, election_id))
-        conn.commit()
-        conn.close()
-        flash("Vote cast!")
-        return redirect('/user')
-    conn.close()
-    return render_template('vote.html', election=election, candidates=candidates)
-
-@app.route('/result/<int:election_id>')
-def result(election_id):
-    if 'role' not in session:
-        return redirect('/login')
-
-    conn = sqlite3.connect('voting.db')
-    election = conn.execute("SELECT * FROM elections WHERE id=?", (election_id,)).fetchone()
-
-    # Check for normal users if election has ended
-    if session['role'] != 'admin':
-        now = datetime.now().isoformat()
-        if now <= election[3]:
-            conn.close()
-            flash("Results are not available until the election ends.")
-            return redirect('/user')
-
-    result = conn.execute(
-        "SELECT candidates.name, COUNT(votes.id) as vote_count FROM votes "
-        "JOIN candidates ON votes.candidate_id = candidates.id "
-        "WHERE votes.election_id = ? "
-        "GROUP BY candidates.name", (election_id,)
-    ).fetchall()
-    conn.close()
-
-    return render_template('result.html', result=result, election=election)
-
-
-
-@app.route('/logout')
-def logout():
-    session.clear()
-    return redirect('/')
-
-if __name__ == '__main__':
-    init_db()
-    app.run(debug=True)
+from flask import Flask, Response, render_template, request, redirect, session, flash, send_file, stream_with_context, url_for
+import sqlite3, os, io, json, math, time, pandas as pd
+import click
+import db, live, importer, export, images, storage, ingest, sessions, passwords, ratelimit, assets, shards, archive, tabulate, ledger
+import lifecycle
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import generate_password_hash
+from metrics import Metrics, Gauge
+from cache import TTLCache
+from db import get_db
+
+app = Flask(__name__)
+app.secret_key = 'voting_secret'
+
+# Defaults; configure_app(config) may override any of them before services start.
+app.config['DATABASE'] = os.environ.get('VOTING_DB', 'voting.db')
+app.config['DB_POOL_SIZE'] = int(os.environ.get('VOTING_DB_POOL_SIZE', 8))
+app.config['DB_SYNCHRONOUS'] = os.environ.get('VOTING_DB_SYNCHRONOUS', 'NORMAL').upper()
+app.config['DB_SLOW_QUERY_MS'] = int(os.environ.get('VOTING_SLOW_QUERY_MS', 100))
+app.config['METRICS_TOKEN'] = os.environ.get('VOTING_METRICS_TOKEN')
+app.config['RESULTS_STREAM_INTERVAL'] = 1.0
+# Optional write-behind ingestion: ballots are group-committed by one writer thread
+app.config['VOTE_GROUP_COMMIT'] = os.environ.get('VOTING_GROUP_COMMIT') == '1'
+app.config['VOTE_BATCH_SIZE'] = 256
+app.config['VOTE_BATCH_DELAY_MS'] = 5
+app.config['VOTE_WRITE_TIMEOUT'] = 30
+# Optional per-election ballot files: elections created while this is on keep
+# their votes and tallies in VOTE_SHARD_FOLDER/election_<id>.db (shards.py)
+app.config['VOTE_SHARDS'] = os.environ.get('VOTING_VOTE_SHARDS') == '1'
+app.config['VOTE_SHARD_FOLDER'] = os.environ.get('VOTING_VOTE_SHARD_FOLDER', 'shards')
+app.config['VOTE_SHARD_POOL_SIZE'] = 4
+app.config['VOTE_SHARDS_OPEN'] = 32
+# Closed elections can be frozen into checksummed snapshot files (archive.py)
+app.config['ARCHIVE_FOLDER'] = os.environ.get('VOTING_ARCHIVE_FOLDER', 'archive')
+app.config['ARCHIVE_COMPRESS'] = True
+app.config['ARCHIVE_VACUUM_PAGES'] = 2000
+# Every ballot is appended to a Merkle ledger (ledger.py) whose root is
+# checkpointed every LEDGER_CHECKPOINT_INTERVAL records
+app.config['LEDGER_CHECKPOINT_INTERVAL'] = 1024
+# Elections open and close at exact instants in their own timezone (an IANA
+# name; new elections default to ELECTION_TIMEZONE, server-local time if
+# unset). LIFECYCLE_CLOSE_GRACE seconds after a close, once ballots already
+# accepted are in, one process freezes the election: tallies checked, ledger
+# checkpointed, exports written and, with ARCHIVE_ON_CLOSE, ballots archived.
+app.config['ELECTION_TIMEZONE'] = os.environ.get('VOTING_TIMEZONE')
+app.config['LIFECYCLE_SCHEDULER'] = os.environ.get('VOTING_LIFECYCLE_SCHEDULER', '1') == '1'
+app.config['LIFECYCLE_CLOSE_GRACE'] = 60
+app.config['LIFECYCLE_POLL'] = 60
+app.config['ARCHIVE_ON_CLOSE'] = os.environ.get('VOTING_ARCHIVE_ON_CLOSE', '1') == '1'
+app.config['METADATA_CACHE_SIZE'] = 512
+app.config['METADATA_CACHE_TTL'] = 30.0
+
+UPLOAD_FOLDER = 'static/uploads'
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['EXPORT_FOLDER'] = os.environ.get('VOTING_EXPORT_FOLDER', 'exports')
+# Uploaded voter rolls wait here until their background import has run
+app.config['IMPORT_FOLDER'] = os.environ.get('VOTING_IMPORT_FOLDER', 'imports')
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['IMAGE_WORKERS'] = int(os.environ.get('VOTING_IMAGE_WORKERS', 2))
+# Replaced raw uploads are deleted this many seconds later if still unreferenced
+app.config['IMAGE_BLOB_GRACE'] = 3600
+# Uploaded photos live in a content-addressed blob store outside static/,
+# served to admins through upload(); see storage.py for the backends.
+app.config['STORAGE_BACKEND'] = os.environ.get('VOTING_STORAGE', 'local')
+app.config['BLOB_FOLDER'] = os.environ.get('VOTING_BLOB_FOLDER', 'blobs')
+app.config['S3_BUCKET'] = os.environ.get('VOTING_S3_BUCKET')
+app.config['S3_ENDPOINT_URL'] = os.environ.get('VOTING_S3_ENDPOINT_URL')
+# Sessions live server-side ('sqlite' is shared by all workers, 'memory' is
+# per process); they expire after SESSION_IDLE_TIMEOUT seconds without a request.
+app.config['SESSION_BACKEND'] = os.environ.get('VOTING_SESSION_BACKEND', 'sqlite')
+app.config['SESSION_IDLE_TIMEOUT'] = int(os.environ.get('VOTING_SESSION_IDLE_TIMEOUT', 1800))
+app.config['SESSION_DATABASE'] = os.environ.get('VOTING_SESSION_DB', 'sessions.db')
+app.config['SESSION_MAX_ENTRIES'] = 10000
+# Password hashing cost as a werkzeug method string; logins are verified on a
+# bounded pool and limited per client address and per username.
+app.config['PASSWORD_METHOD'] = os.environ.get('VOTING_PASSWORD_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_WORKERS'] = int(os.environ.get('VOTING_PASSWORD_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_MAX_PENDING'] = 64
+app.config['PASSWORD_BULK_WORKERS'] = int(os.environ.get('VOTING_PASSWORD_BULK_WORKERS', max(1, (os.cpu_count() or 1) // 2)))
+app.config['LOGIN_RATE'] = 0.2
+app.config['LOGIN_BURST'] = 10
+# Reverse proxies in front of the app (e.g. 1 for nginx). Their X-Forwarded-*
+# headers are trusted for that many hops, so request.remote_addr, and with it
+# the per-address login limit, is the client's address and not the proxy's.
+app.config['PROXY_HOPS'] = int(os.environ.get('VOTING_PROXY_HOPS', 0))
+# Token buckets for login (per client address and username) and voting (per
+# user). 'memory' is per process; 'sqlite' shares them between workers
+# through a small database file of their own.
+app.config['RATELIMIT_BACKEND'] = os.environ.get('VOTING_RATELIMIT_BACKEND', 'memory')
+app.config['RATELIMIT_DATABASE'] = os.environ.get('VOTING_RATELIMIT_DB', 'ratelimit.db')
+app.config['VOTE_RATE'] = 1.0
+app.config['VOTE_BURST'] = 20
+# At most VOTE_ADMIT_CONCURRENCY ballot writes per process at once; a ballot
+# that would queue longer than VOTE_ADMIT_MAX_WAIT seconds at the current
+# write latency gets a 503 with Retry-After instead. None means 8, or with
+# group commit VOTE_BATCH_SIZE: a ballot then waits out the batching window
+# on the writer, and a batch can only fill if that many are in flight.
+app.config['VOTE_ADMIT_CONCURRENCY'] = None
+app.config['VOTE_ADMIT_MAX_WAIT'] = 1.0
+
+# Per-process services, built by configure_app()
+metrics = None
+tally_feeds = None
+vote_writer = None
+vote_shards = None
+snapshots = None
+metadata_cache = None
+blob_store = None
+image_pipeline = None
+import_jobs = None
+session_store = None
+password_hasher = None
+login_limiter = None
+vote_limiter = None
+vote_admission = None
+static_assets = None
+election_lifecycle = None
+
+def configure_app(config=None):
+    """Configure the module-level ``app`` and its services, and migrate the database.
+
+    This is one-shot setup of a single app per process, not a factory: the
+    routes are bound to ``app`` and the services are module globals, so
+    there is no second, independent instance to build. Call it once per
+    process (wsgi.py and serve.py do) before serving; later calls return
+    the same ``app``, and one passing ``config`` raises RuntimeError rather
+    than leave services built from the old settings. With a preloading
+    server it runs in the master, so migrations happen once before workers
+    fork. Nothing here opens a pooled connection or starts a thread, which
+    keeps the result safe to fork.
+    """
+    global metrics, tally_feeds, vote_writer, metadata_cache, blob_store, image_pipeline, session_store
+    global password_hasher, login_limiter, static_assets, vote_shards, snapshots, election_lifecycle
+    global vote_limiter, vote_admission, import_jobs
+    if 'voting' in app.extensions:
+        if config:
+            raise RuntimeError("configure_app() already ran in this process; its config cannot change")
+        return app
+    if config:
+        app.config.from_mapping(config)
+    app.extensions['voting'] = True
+
+    if app.config['PROXY_HOPS']:
+        hops = app.config['PROXY_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+    db.init_app(app)
+    ledger.checkpoint_interval = app.config['LEDGER_CHECKPOINT_INTERVAL']
+    metrics = Metrics(app)
+    # Always available so shards created earlier stay readable with VOTE_SHARDS off
+    vote_shards = shards.VoteShards(app, app.config['VOTE_SHARD_FOLDER'],
+                                    pool_size=app.config['VOTE_SHARD_POOL_SIZE'],
+                                    max_open=app.config['VOTE_SHARDS_OPEN'])
+    snapshots = archive.SnapshotCache(app.config['ARCHIVE_FOLDER'])
+    tally_feeds = live.TallyFeeds(app, interval=app.config['RESULTS_STREAM_INTERVAL'], pool_for=votes_pool)
+    vote_writer = ingest.VoteWriter(app, batch_size=app.config['VOTE_BATCH_SIZE'],
+                                    max_delay=app.config['VOTE_BATCH_DELAY_MS'] / 1000,
+                                    on_commit=tally_feeds.notify,
+                                    shards=vote_shards) if app.config['VOTE_GROUP_COMMIT'] else None
+    metadata_cache = TTLCache(maxsize=app.config['METADATA_CACHE_SIZE'], ttl=app.config['METADATA_CACHE_TTL'])
+    metrics.add(Gauge('voting_metadata_cache', 'Election metadata cache size and hit/miss/eviction counts.',
+                      lambda: {(k,): v for k, v in metadata_cache.stats().items()}, ('stat',)))
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    blob_store = storage.from_config(app.config)
+    image_pipeline = images.ImagePipeline(app, blob_store, max_workers=app.config['IMAGE_WORKERS'],
+                                           grace=app.config['IMAGE_BLOB_GRACE'])
+    session_store = sessions.from_config(app)
+    app.session_interface = sessions.ServerSessionInterface(session_store)
+    if app.config['SESSION_BACKEND'] == 'memory':
+        metrics.add(Gauge('voting_sessions', 'Server-side session count and LRU evictions.',
+                          lambda: {(k,): v for k, v in session_store.stats().items()}, ('stat',)))
+    password_hasher = passwords.PasswordHasher(app.config['PASSWORD_METHOD'],
+                                               max_workers=app.config['PASSWORD_WORKERS'],
+                                               max_pending=app.config['PASSWORD_MAX_PENDING'],
+                                               bulk_workers=app.config['PASSWORD_BULK_WORKERS'])
+    import_jobs = importer.ImportJobs(app, app.config['IMPORT_FOLDER'], hash_passwords=password_hasher.hash_many)
+    login_limiter = ratelimit.from_config(app, 'login', app.config['LOGIN_RATE'], app.config['LOGIN_BURST'])
+    vote_limiter = ratelimit.from_config(app, 'vote', app.config['VOTE_RATE'], app.config['VOTE_BURST'])
+    concurrency = app.config['VOTE_ADMIT_CONCURRENCY'] or (
+        app.config['VOTE_BATCH_SIZE'] if app.config['VOTE_GROUP_COMMIT'] else 8)
+    vote_admission = ratelimit.AdmissionControl(concurrency, app.config['VOTE_ADMIT_MAX_WAIT'])
+    metrics.add(Gauge('voting_vote_admission', 'Ballot writes running and queued, admitted and shed '
+                      'totals, and the moving average write latency.',
+                      lambda: {(k,): v for k, v in vote_admission.stats().items()}, ('stat',)))
+    static_assets = assets.Assets(app)
+    election_lifecycle = lifecycle.Lifecycle(app, on_open=open_elections, on_close=close_elections,
+                                             on_finalize=finalize_election,
+                                             grace=app.config['LIFECYCLE_CLOSE_GRACE'],
+                                             poll=app.config['LIFECYCLE_POLL'])
+    if app.config['LIFECYCLE_SCHEDULER']:
+        # Started by the first request, so a preloading server forks before the thread exists
+        app.before_request(election_lifecycle.start)
+    # Compile every template now: syntax errors surface at startup and no
+    # request pays for parsing (templates are not re-checked unless debugging)
+    for name in app.jinja_env.list_templates(extensions=('html',)):
+        app.jinja_env.get_template(name)
+    init_db()
+    return app
+
+def allowed_file(fname):
+    return '.' in fname and fname.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+# Elections and candidates only change through the admin routes, so voter
+# pages read them through metadata_cache and those routes invalidate it.
+def get_election(election_id):
+    return metadata_cache.get_or_load(('election', election_id), lambda:
+        get_db().execute("SELECT * FROM elections WHERE id=?", (election_id,)).fetchone())
+
+def get_candidates(election_id):
+    return metadata_cache.get_or_load(('candidates', election_id), lambda: tuple(
+        get_db().execute("SELECT * FROM candidates WHERE election_id=?", (election_id,)).fetchall()))
+
+def invalidate_election(election_id):
+    metadata_cache.invalidate(('election', election_id), ('candidates', election_id),
+                              ('candidate_list', election_id), ('result_table', election_id),
+                              ('result_json', election_id))
+
+def render_fragment(key, template, load):
+    """Render a partial that is the same for every viewer once and reuse the HTML
+    from metadata_cache; ``load`` returns its context and only runs on a miss."""
+    return metadata_cache.get_or_load(key, lambda: Markup(render_template(template, **load())))
+
+def votes_db(election):
+    """The request's connection to the database holding this election's votes and tallies."""
+    # An archived election's shard is gone; its (now empty) rows read as the main database's
+    return vote_shards.get_db(election[0]) if election[6] and not election[7] else get_db()
+
+def votes_pool(election_id):
+    """Like votes_db() for code running outside a request (the live tally feeds)."""
+    with app.app_context():
+        election = get_election(election_id)
+    return vote_shards.pool(election_id) if election and election[6] and not election[7] else db.get_pool(app)
+
+@app.template_global()
+def election_state(election, now=None):
+    """'draft', 'open' or 'closed', from the instants on the (cached) election row."""
+    return lifecycle.state(election[4], election[5], now)
+
+def election_closed(election):
+    return election_state(election) == 'closed'
+
+def candidate_list(election):
+    return render_fragment(('candidate_list', election[0]), '_candidate_list.html',
+                           lambda: {'candidates': get_candidates(election[0]), 'method': election[8],
+                                    'seats': election[9]})
+
+def open_elections(election_ids):
+    """Lifecycle hook: load what the first voters will need before they arrive."""
+    for election_id in election_ids:
+        invalidate_election(election_id)
+        election = get_election(election_id)
+        if election is None:
+            continue
+        candidate_list(election)
+        if election[6]:
+            pool = vote_shards.pool(election_id)
+            pool.release(pool.acquire())
+
+def close_elections(election_ids):
+    """Lifecycle hook: stop serving this process's cached view of elections that just closed."""
+    for election_id in election_ids:
+        invalidate_election(election_id)
+        tally_feeds.notify(election_id)
+
+def finalize_election(election_id):
+    """Lifecycle hook, run once per election after its close grace period."""
+    invalidate_election(election_id)
+    election = get_election(election_id)
+    if election is None or election[7]:
+        return
+    conn = votes_db(election)
+    if db.check_tallies(conn, election_id):
+        app.logger.warning("election %s: tallies disagreed with the ballots at close; rebuilt", election_id)
+        db.rebuild_tallies(conn, election_id)
+    if app.config['ARCHIVE_ON_CLOSE']:
+        archive_election(election_id)
+    else:
+        with conn:
+            ledger.checkpoint(conn, election_id)
+        counts = export_counts(election)
+        for fmt in export.FORMATS:
+            export.write_artifact(conn, election, fmt, app.config['EXPORT_FOLDER'], **counts)
+    invalidate_election(election_id)
+    tally_feeds.discard(election_id)
+
+def tabulate_election(election):
+    """Count a ranked or approval election's ballots (from its snapshot once archived)."""
+    candidates = get_candidates(election[0])
+    if election[7]:
+        marks = snapshots.get(election[0]).ranks() or ((), ())
+    else:
+        marks = tabulate.from_blobs(row[0] for row in votes_db(election).execute(
+            "SELECT ranks FROM votes WHERE election_id=? AND ranks IS NOT NULL", (election[0],)))
+    return tabulate.tabulate(election[8], [c[0] for c in candidates], *marks, seats=election[9])
+
+def export_counts(election):
+    """Keyword arguments for export: ranked and approval elections export their tabulation."""
+    if election[8] == 'plurality':
+        return {}
+    return {'tabulation': tabulate_election(election), 'candidates': get_candidates(election[0])}
+
+def audit_election(election, full=False):
+    """Verify an election's ledger and that its ballots, live or archived, are the ones it records."""
+    election_id = election[0]
+    conn = votes_db(election)
+    report = ledger.audit(conn, election_id, full=full, ballots=not election[7])
+    if election[7]:
+        try:
+            snap = snapshots.get(election_id)
+        except archive.SnapshotError as e:
+            report['errors'].append(f"the archived ballots are unavailable: {e}")
+            return report
+        recorded = ledger.live_ballots(conn, election_id).fetchall()
+        marks = snap.ranks()
+        if ([r[:3] for r in recorded] != list(snap.ballots())
+                or b''.join(r[3] or b'' for r in recorded) != (tabulate.encode(marks[1]) if marks else b'')):
+            report['errors'].append("the archived ballots differ from the ledger")
+    else:
+        report['errors'] += [f"candidate {cid}: tally {tally} but {actual} ballots"
+                             for _, cid, tally, actual in db.check_tallies(conn, election_id)]
+    return report
+
+def read_ballot(election, form):
+    """(candidate_id, ranks) from a submitted ballot form; raises ValueError with a message for the voter."""
+    candidates = get_candidates(election[0])
+    if election[8] in ('plurality', 'approval'):
+        chosen = set(form.getlist('candidate'))
+        marks = [c[0] for c in candidates if str(c[0]) in chosen]
+    else:
+        ranked = []
+        for c in candidates:
+            value = form.get(f"rank_{c[0]}", '')
+            if value:
+                if not value.isdigit():
+                    raise ValueError("Invalid ballot.")
+                ranked.append((int(value), c[0]))
+        if len({r for r, _ in ranked}) != len(ranked):
+            raise ValueError("Each rank can only be given to one candidate.")
+        marks = [cid for _, cid in sorted(ranked)]
+    return ballot_from_marks(election, marks)
+
+def ballot_from_marks(election, marks):
+    """(candidate_id, ranks) from candidate ids in the voter's order of preference."""
+    candidates = get_candidates(election[0])
+    if not marks:
+        raise ValueError("Mark at least one candidate.")
+    if not set(marks) <= {c[0] for c in candidates}:
+        raise ValueError("Invalid ballot.")
+    if len(set(marks)) != len(marks):
+        raise ValueError("Each candidate can only be marked once.")
+    if election[8] == 'plurality':
+        if len(marks) > 1:
+            raise ValueError("Mark only one candidate.")
+        return marks[0], None
+    if election[8] == 'approval':
+        # Stored in listing order, whatever order they were ticked in
+        marks = [c[0] for c in candidates if c[0] in set(marks)]
+    return marks[0], tabulate.encode(marks)
+
+def archive_election(election_id, compress=None):
+    """Freeze a closed election's ballots into a snapshot and drop its live rows.
+
+    Returns False if the election is missing, still open or already archived.
+    """
+    election = get_election(election_id)
+    if election is None or election[7] or not election_closed(election):
+        return False
+    conn, ballots = get_db(), votes_db(election)
+    with ballots:
+        ledger.checkpoint(ballots, election_id)
+    # Exports are rendered while the rows still exist; afterwards they are served from disk
+    counts = export_counts(election)
+    for fmt in export.FORMATS:
+        export.write_artifact(ballots, election, fmt, app.config['EXPORT_FOLDER'], **counts)
+    candidates = conn.execute("SELECT id, name, party FROM candidates WHERE election_id=? ORDER BY id",
+                              (election_id,)).fetchall()
+    path = archive.write_snapshot(
+        archive.path_for(app.config['ARCHIVE_FOLDER'], election_id), election, candidates,
+        ballots.execute("SELECT id, user_id, candidate_id, ranks FROM votes WHERE election_id=? ORDER BY id",
+                        (election_id,)),
+        compress=app.config['ARCHIVE_COMPRESS'] if compress is None else compress)
+    frozen = dict(archive.Snapshot(path).tallies())
+    live_tallies = dict(ballots.execute("SELECT candidate_id, count FROM tallies WHERE election_id=?",
+                                        (election_id,)).fetchall())
+    if {k: v for k, v in frozen.items() if v} != {k: v for k, v in live_tallies.items() if v}:
+        app.logger.warning("election %s: tallies disagreed with the ballots; the snapshot uses the ballots",
+                           election_id)
+    if election[6]:
+        # The ledger outlives the shard: it is what the snapshot is audited against
+        with ballots:
+            ledger.copy_to(ballots, election_id, 'core')
+    with conn:
+        if not election[6]:
+            conn.execute("DELETE FROM votes WHERE election_id=?", (election_id,))
+            conn.execute("DELETE FROM tallies WHERE election_id=?", (election_id,))
+        conn.execute("UPDATE elections SET archived=1 WHERE id=?", (election_id,))
+    if election[6]:
+        vote_shards.drop(election_id)
+    else:
+        db.incremental_vacuum(conn, app.config['ARCHIVE_VACUUM_PAGES'])
+    invalidate_election(election_id)
+    tally_feeds.discard(election_id)
+    return True
+
+def cast_vote(user_id, election, candidate_id, ranks=None):
+    """Durably record a ballot; returns False if the user already voted.
+
+    Raises ingest.Unconfirmed if the group-commit writer has not answered
+    within VOTE_WRITE_TIMEOUT seconds.
+    """
+    election_id = election[0]
+    if vote_writer is not None:
+        future = vote_writer.submit(user_id, election_id, candidate_id, sharded=bool(election[6]), ranks=ranks)
+        try:
+            return future.result(timeout=app.config['VOTE_WRITE_TIMEOUT'])
+        except TimeoutError:
+            raise ingest.Unconfirmed() from None
+    conn = votes_db(election)
+    # "Vote cast!" must survive power loss: fsync this commit as the writer does,
+    # whatever DB_SYNCHRONOUS the rest of the request's writes use
+    conn.execute("PRAGMA synchronous=FULL")
+    # The unique (user_id, election_id) index makes the insert itself the duplicate check
+    try:
+        db.record_vote(conn, user_id, election_id, candidate_id, ranks)
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        return False
+    finally:
+        conn.execute(f"PRAGMA synchronous={app.config['DB_SYNCHRONOUS']}")
+    tally_feeds.notify(election_id)
+    return True
+
+@app.errorhandler(ingest.Unconfirmed)
+def vote_unconfirmed(e):
+    message = "Your vote could not be confirmed yet; check your dashboard before voting again."
+    if request.path.startswith('/api/'):
+        return {'error': message}, 503, {'Retry-After': '5'}
+    return message, 503, {'Retry-After': '5'}
+
+@app.errorhandler(archive.SnapshotError)
+def snapshot_unavailable(e):
+    app.logger.error("archive snapshot unavailable: %s", e)
+    message = "The archive of this election is unavailable; please try again later."
+    if request.path.startswith('/api/'):
+        return {'error': message}, 503, {'Retry-After': '60'}
+    return message, 503, {'Retry-After': '60'}
+
+@app.errorhandler(db.PoolExhausted)
+def pool_exhausted(e):
+    app.logger.warning("no database connection free within the busy timeout: %s", e)
+    message = "The server is busy; please try again shortly."
+    if request.path.startswith('/api/'):
+        return {'error': message}, 503, {'Retry-After': '1'}
+    return message, 503, {'Retry-After': '1'}
+
+def init_db():
+    conn = db.get_pool(app).connect()
+    version, _ = db.migrate(conn)
+    if version < 2:
+        quarantined = conn.execute("SELECT COUNT(*) FROM votes_quarantine").fetchone()[0]
+        if quarantined:
+            app.logger.warning("moved %d duplicate ballot(s) into votes_quarantine; only each "
+                               "voter's first ballot per election is counted", quarantined)
+    if not conn.execute("SELECT 1 FROM users WHERE username='admin'").fetchone():
+        # Hashed inline: the password pool's threads must not start before a preloading server forks
+        conn.execute("INSERT INTO users(username,password,role,verified) VALUES('admin',?,'admin',1)",
+                     (generate_password_hash('admin123', app.config['PASSWORD_METHOD']),))
+    conn.commit()
+    # Shards used to be created by their first connection
+    for (election_id,) in conn.execute("SELECT id FROM elections WHERE sharded=1 AND archived=0"):
+        if not os.path.exists(vote_shards.path(election_id)):
+            vote_shards.create(election_id)
+    conn.close()
+
+@app.route('/')
+def home():
+    return render_template('home.html')
+
+@app.route('/register', methods=['GET','POST'])
+def register():
+    if request.method == 'POST':
+        u = request.form['username']
+        p = request.form['password']
+        name = request.form['name']
+        dob = request.form['dob']
+        cid = request.form['citizenship_id']
+        cit = request.files.get('citizenship_photo')
+        per = request.files.get('personal_photo')
+
+        if not (cit and per and allowed_file(cit.filename) and allowed_file(per.filename)):
+            flash("Please upload two valid image files.")
+            return redirect('/register')
+        try:
+            p = password_hasher.hash(p)
+        except passwords.Busy:
+            flash("Registration is busy right now; please try again in a moment.")
+            return render_template('register.html'), 503, {'Retry-After': '1'}
+
+        cit_name = blob_store.put(cit.read(), cit.filename.rsplit('.', 1)[1])
+        per_name = blob_store.put(per.read(), per.filename.rsplit('.', 1)[1])
+
+        try:
+            conn = get_db()
+            cur = conn.execute("""
+            INSERT INTO users(username,password,name,dob,citizenship_id,citizenship_photo,personal_photo)
+            VALUES(?,?,?,?,?,?,?)""",
+                         (u,p,name,dob,cid,cit_name,per_name))
+            conn.commit()
+            # Validation, metadata stripping and thumbnails happen off the request thread
+            image_pipeline.submit(cur.lastrowid, {'citizenship': cit_name, 'personal': per_name})
+            flash("Registered! Await admin approval.")
+            return redirect('/login')
+        except sqlite3.IntegrityError:
+            flash("Username already exists.")
+    return render_template('register.html')
+
+@app.template_global()
+def photo_url(name):
+    if storage.is_key(name):
+        return url_for('upload', key=name)
+    return url_for('static', filename='uploads/' + name)
+
+@app.route('/uploads/<path:key>')
+def upload(key):
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    if not storage.is_key(key):
+        return "Not found.", 404
+    # A key is the hash of its content, so the bytes behind a URL never change
+    path = blob_store.local_path(key)
+    if path is not None:
+        if not os.path.exists(path):
+            return "Not found.", 404
+        resp = send_file(os.path.abspath(path), mimetype=storage.key_mimetype(key),
+                         etag=storage.key_hash(key), max_age=31536000, conditional=True)
+    else:
+        resp = Response(blob_store.get(key), mimetype=storage.key_mimetype(key))
+        resp.set_etag(storage.key_hash(key))
+        resp.make_conditional(request)
+    resp.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return resp
+
+@app.route('/login', methods=['GET','POST'])
+def login():
+    if request.method=='POST':
+        u = request.form['username']
+        p = request.form['password']
+        wait = max(login_limiter.hit(('addr', request.remote_addr)), login_limiter.hit(('user', u)))
+        if wait:
+            flash("Too many login attempts; please wait a moment.")
+            return render_template('login.html'), 429, {'Retry-After': str(math.ceil(wait))}
+        conn = get_db()
+        user = conn.execute("""
+            SELECT id, username, password, name, dob, citizenship_id, citizenship_photo,
+                   personal_photo, verified, role
+            FROM users WHERE username=?""", (u,)).fetchone()
+        try:
+            ok, new_hash = password_hasher.check(user[2] if user else None, p)
+        except passwords.Busy:
+            flash("Login is busy right now; please try again in a moment.")
+            return render_template('login.html'), 503, {'Retry-After': '1'}
+        if not ok:
+            flash("Invalid credentials.")
+            return redirect('/login')
+
+        (uid, uname, pwd, name, dob, cid, cit_photo,
+         per_photo, verified, role) = user
+        if new_hash:
+            # Plaintext or outdated hash: upgrade it now that we know the password
+            conn.execute("UPDATE users SET password=? WHERE id=? AND password=?", (new_hash, uid, pwd))
+            conn.commit()
+
+        if role != 'admin' and verified == 0:
+            flash("Awaiting admin approval.")
+            return redirect('/login')
+
+        session.clear()
+        session.regenerate()
+        session['user_id'] = uid
+        session['username'] = uname
+        session['role'] = role
+        session['verified'] = bool(verified)
+        session['logged_in'] = True
+        return redirect('/dashboard')
+    return render_template('login.html')
+
+@app.route('/dashboard')
+def dashboard():
+    if 'role' not in session:
+        return redirect('/login')
+    return redirect('/admin') if session['role']=='admin' else redirect('/user')
+
+@app.route('/admin')
+def admin_dashboard():
+    if session.get('role')!='admin':
+        return redirect('/login')
+    return render_template('admin_dashboard.html')
+
+@app.route('/admin/manage_election', methods=['GET', 'POST'])
+def manage_election():
+    if session.get('role') != 'admin':
+        return redirect(url_for('login'))
+
+    conn = get_db()
+    cursor = conn.cursor()
+
+    # Handle creating a new election
+    if request.method == 'POST' and 'create_election' in request.form:
+        title = request.form['title']
+        start_date = request.form['start_date']
+        end_date = request.form['end_date']
+        timezone = request.form.get('timezone', '').strip() or app.config['ELECTION_TIMEZONE']
+        method = request.form.get('method', 'plurality')
+        seats = max(request.form.get('seats', 1, type=int) or 1, 1)
+        try:
+            opens_at, closes_at = lifecycle.instants(start_date, end_date, timezone)
+            if method not in tabulate.METHODS:
+                raise ValueError("Unknown counting method.")
+        except ValueError as e:
+            flash(str(e))
+        else:
+            cursor.execute("""INSERT INTO elections(title, start_date, end_date, start_ts, end_ts, timezone, state,
+                                                   sharded, method, seats)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                           (title, start_date, end_date, opens_at, closes_at, timezone,
+                            lifecycle.state(opens_at, closes_at), int(app.config['VOTE_SHARDS']), method,
+                            seats if method in ('stv', 'approval') else 1))
+            if app.config['VOTE_SHARDS']:
+                vote_shards.create(cursor.lastrowid)
+            conn.commit()
+            invalidate_election(cursor.lastrowid)
+            election_lifecycle.wake()
+            flash("Election created.")
+
+    # Handle adding a candidate
+    if request.method == 'POST' and 'add_candidate' in request.form:
+        name = request.form['candidate_name']
+        party = request.form['party']
+        election_id = request.form['election_id']
+        cursor.execute("INSERT INTO candidates(name, party, election_id) VALUES (?, ?, ?)",
+                       (name, party, election_id))
+        conn.commit()
+        invalidate_election(int(election_id))
+        flash("Candidate added.")
+
+    # Fetch elections and candidates
+    cursor.execute("SELECT * FROM elections")
+    elections = cursor.fetchall()
+
+    cursor.execute("""
+        SELECT c.id, c.name, c.party, c.election_id, e.title
+        FROM candidates c
+        LEFT JOIN elections e ON c.election_id = e.id
+    """)
+    candidates = cursor.fetchall()
+
+    return render_template('manage_election.html', elections=elections, candidates=candidates,
+                           methods=tabulate.METHODS, timezone=app.config['ELECTION_TIMEZONE'])
+
+@app.route('/admin/delete_election/<int:election_id>', methods=['POST'])
+def delete_election(election_id):
+    if session.get('role') != 'admin':
+        return redirect(url_for('login'))
+    election = get_election(election_id)
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM candidates WHERE election_id=?", (election_id,))
+    if not (election and election[6]):
+        cursor.execute("DELETE FROM votes WHERE election_id=?", (election_id,))
+        cursor.execute("DELETE FROM tallies WHERE election_id=?", (election_id,))
+    cursor.execute("DELETE FROM elections WHERE id=?", (election_id,))
+    # Only allowed now that the election is gone (see the ledger triggers)
+    for table in ledger.TABLES:
+        cursor.execute(f"DELETE FROM {table} WHERE election_id=?", (election_id,))
+    conn.commit()
+    if election and election[6]:
+        vote_shards.drop(election_id)
+    if election and election[7]:
+        snapshots.discard(election_id)
+    invalidate_election(election_id)
+    tally_feeds.discard(election_id)
+    election_lifecycle.wake()
+    export.purge_artifacts(app.config['EXPORT_FOLDER'], election_id)
+    flash("Election and related data deleted.")
+    return redirect(url_for('manage_election'))
+
+@app.route('/admin/delete_candidate/<int:candidate_id>', methods=['POST'])
+def delete_candidate(candidate_id):
+    if session.get('role') != 'admin':
+        return redirect(url_for('login'))
+    conn = get_db()
+    cursor = conn.cursor()
+    row = cursor.execute("SELECT election_id FROM candidates WHERE id=?", (candidate_id,)).fetchone()
+    election = get_election(row[0]) if row else None
+    ballots = votes_db(election) if election else conn
+    if election:
+        remaining = {c[0] for c in get_candidates(election[0])} - {candidate_id}
+        # Withdrawn ballots are voided in the ledger, not silently dropped. Ranked and
+        # approval ballots keep their other marks: they move on to the next one left.
+        for vote in ballots.execute("SELECT id, user_id, candidate_id, ranks FROM votes "
+                                    "WHERE election_id=? AND candidate_id=?", (election[0], candidate_id)).fetchall():
+            marks = tabulate.decode(vote[3]) if vote[3] is not None else ()
+            following = next((cid for cid in marks if cid in remaining), None)
+            if following is None:
+                ledger.append(ballots, election[0], 'void', *vote)
+                continue
+            ballots.execute("UPDATE votes SET candidate_id=? WHERE id=?", (following, vote[0]))
+            ballots.execute("""
+                INSERT INTO tallies(election_id, candidate_id, count) VALUES(?,?,1)
+                ON CONFLICT(election_id, candidate_id) DO UPDATE SET count=count+1
+            """, (election[0], following))
+            ledger.append(ballots, election[0], 'amend', vote[0], vote[1], following, vote[3])
+    ballots.execute("DELETE FROM votes WHERE candidate_id=?", (candidate_id,))
+    ballots.execute("DELETE FROM tallies WHERE candidate_id=?", (candidate_id,))
+    cursor.execute("DELETE FROM candidates WHERE id=?", (candidate_id,))
+    if ballots is not conn:
+        ballots.commit()
+    conn.commit()
+    if row:
+        invalidate_election(row[0])
+        tally_feeds.notify(row[0])
+        export.purge_artifacts(app.config['EXPORT_FOLDER'], row[0])
+    flash("Candidate deleted.")
+    return redirect(url_for('manage_election'))
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    # Scrapers can authenticate with a bearer token instead of an admin session
+    token = app.config['METRICS_TOKEN']
+    if session.get('role') != 'admin' and not (
+            token and request.headers.get('Authorization') == f"Bearer {token}"):
+        return redirect('/login')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/import_voters', methods=['GET', 'POST'])
+def import_voters():
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    if request.method == 'POST':
+        roll = request.files.get('roll')
+        if not (roll and roll.filename.lower().endswith(('.csv', '.xlsx'))):
+            flash("Please upload a .csv or .xlsx file.")
+            return redirect(url_for('import_voters'))
+        job_id = import_jobs.submit(get_db(), roll.stream, roll.filename, verified='verify' in request.form)
+        return redirect(url_for('import_voters_job', job_id=job_id))
+    jobs = get_db().execute("""SELECT id, filename, status, inserted, rejected, created FROM import_jobs
+                               ORDER BY id DESC LIMIT 20""").fetchall()
+    return render_template('import_voters.html', jobs=jobs)
+
+@app.route('/admin/import_voters/<int:job_id>')
+def import_voters_job(job_id):
+    """An import's progress; JSON for clients that ask for it, else a page that refreshes until it ends."""
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    job = import_jobs.get(get_db(), job_id)
+    if job is None:
+        return "Import not found.", 404
+    if request.accept_mimetypes.best == 'application/json':
+        return job
+    return render_template('import_voters.html', job=job)
+
+@app.route('/admin/verify_users')
+def verify_users():
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    status = request.args.get('status', 'all')
+    q = request.args.get('q', '').strip()
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    per_page = max(1, min(request.args.get('per_page', 50, type=int), 500))
+
+    where, args = ["role='user'"], []
+    if status in ('pending', 'verified'):
+        where.append("verified=?")
+        args.append(1 if status == 'verified' else 0)
+    if q:
+        where.append("(citizenship_id=? OR username=? OR name LIKE ?)")
+        args += [q, q, q + '%']
+    # Keyset pagination on id: seeks straight to the page instead of OFFSET-scanning
+    if before is not None:
+        where.append("id<?")
+        args.append(before)
+        order = "DESC"
+    else:
+        where.append("id>?")
+        args.append(after or 0)
+        order = "ASC"
+    conn = get_db()
+    users = conn.execute(f"""
+        SELECT id, username, name, dob, citizenship_id, citizenship_photo, personal_photo, verified,
+               citizenship_thumb, personal_thumb, photos_status
+        FROM users
+        WHERE {' AND '.join(where)}
+        ORDER BY id {order} LIMIT ?
+    """, args + [per_page + 1]).fetchall()
+    more = len(users) > per_page
+    users = users[:per_page]
+    if before is not None:
+        users.reverse()
+    has_next = more if before is None else True
+    has_prev = (more if before is not None else bool(after)) and bool(users)
+    filters = {'status': status, 'q': q, 'per_page': per_page}
+    return render_template('verify_users.html', users=users, filters=filters,
+                           next_after=users[-1][0] if users and has_next else None,
+                           prev_before=users[0][0] if has_prev else None)
+
+@app.route('/admin/users/bulk', methods=['POST'])
+def bulk_users():
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        action, ids = payload.get('action'), payload.get('user_ids', [])
+    else:
+        action, ids = request.form.get('action'), request.form.getlist('user_ids')
+    try:
+        ids = [int(i) for i in ids]
+    except (TypeError, ValueError):
+        ids = None
+    if action not in ('approve', 'reject') or ids is None:
+        if request.is_json:
+            return {'error': 'action must be approve or reject and user_ids a list of ids'}, 400
+        flash("Invalid bulk action.")
+        return redirect(request.referrer or url_for('verify_users'))
+    conn = get_db()
+    with conn:
+        # RETURNING gives the rows the status guard let through; only their sessions change
+        if action == 'approve':
+            done = [r[0] for r in conn.execute(
+                "UPDATE users SET verified=1 WHERE id IN (SELECT value FROM json_each(?)) "
+                "AND role='user' AND verified=0 RETURNING id", (json.dumps(ids),)).fetchall()]
+        else:
+            # Rejecting only removes registrations that were never approved
+            done = [r[0] for r in conn.execute(
+                "DELETE FROM users WHERE id IN (SELECT value FROM json_each(?)) "
+                "AND role='user' AND verified=0 RETURNING id", (json.dumps(ids),)).fetchall()]
+    for uid in done:
+        if action == 'approve':
+            session_store.update_user(uid, verified=True)
+        else:
+            session_store.revoke_user(uid)
+    changed = len(done)
+    if request.is_json:
+        return {'action': action, 'requested': len(ids), 'changed': changed,
+                'skipped': len(ids) - changed}
+    flash(f"{changed} user(s) {'approved' if action == 'approve' else 'rejected'}, "
+          f"{len(ids) - changed} skipped.")
+    return redirect(request.referrer or url_for('verify_users'))
+
+@app.route('/admin/approve_user/<int:user_id>')
+def approve_user(user_id):
+    if session.get('role')!='admin':
+        return redirect('/login')
+    conn = get_db()
+    conn.execute("UPDATE users SET verified=1 WHERE id=?", (user_id,))
+    conn.commit()
+    session_store.update_user(user_id, verified=True)
+    flash("User approved.")
+    return redirect('/admin/verify_users')
+
+@app.route('/delete_user/<int:user_id>', methods=['POST'])
+def delete_user(user_id):
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM users WHERE id=?", (user_id,))
+    conn.commit()
+    session_store.revoke_user(user_id)
+    flash("User deleted successfully.")
+    return redirect(url_for('verify_users'))
+
+@app.route('/admin/users/<int:user_id>/revoke_sessions', methods=['POST'])
+def revoke_sessions(user_id):
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    flash(f"Signed out {session_store.revoke_user(user_id)} session(s).")
+    return redirect(request.referrer or url_for('verify_users'))
+
+
+def voter_elections(user_id, page=1, per_page=20):
+    """A voter's (id, title, start_date, end_date) elections as {'ongoing', 'future',
+    'expired'} lists, the ids they voted in, and whether more expired pages follow."""
+    now = int(time.time())
+    # One statement: three index range scans on start_ts/end_ts, each joined to
+    # this user's ballot. Only the expired history is paginated.
+    rows = get_db().execute("""
+        SELECT * FROM (
+          SELECT 'ongoing', e.id, e.title, e.start_date, e.end_date, v.id IS NOT NULL
+          FROM elections e LEFT JOIN votes v ON v.election_id = e.id AND v.user_id = :uid
+          WHERE e.start_ts <= :now AND e.end_ts > :now
+          ORDER BY e.end_ts)
+        UNION ALL
+        SELECT * FROM (
+          SELECT 'future', e.id, e.title, e.start_date, e.end_date, 0
+          FROM elections e LEFT JOIN votes v ON v.election_id = e.id AND v.user_id = :uid
+          WHERE e.start_ts > :now
+          ORDER BY e.start_ts)
+        UNION ALL
+        SELECT * FROM (
+          SELECT 'expired', e.id, e.title, e.start_date, e.end_date, v.id IS NOT NULL
+          FROM elections e LEFT JOIN votes v ON v.election_id = e.id AND v.user_id = :uid
+          WHERE e.end_ts <= :now
+          ORDER BY e.end_ts DESC, e.id DESC
+          LIMIT :limit OFFSET :offset)
+    """, {'uid': user_id, 'now': now,
+          'limit': per_page + 1, 'offset': (page - 1) * per_page}).fetchall()
+
+    buckets = {'ongoing': [], 'future': [], 'expired': []}
+    voted_ids = set()
+    for bucket, *election, voted in rows:
+        buckets[bucket].append(election)
+        if voted:
+            voted_ids.add(election[0])
+    has_more = len(buckets['expired']) > per_page
+    buckets['expired'] = buckets['expired'][:per_page]
+    # Ballots in shard files and archive snapshots are invisible to the join above
+    for election in buckets['ongoing'] + buckets['expired']:
+        full = get_election(election[0])
+        if full[7]:
+            try:
+                voted = snapshots.get(election[0]).has_voter(user_id)
+            except archive.SnapshotError:
+                continue  # the results page reports it; the dashboard still lists the election
+        elif full[6]:
+            voted = votes_db(full).execute("SELECT 1 FROM votes WHERE user_id=? AND election_id=?",
+                                           (user_id, election[0])).fetchone()
+        else:
+            continue
+        if voted:
+            voted_ids.add(election[0])
+    return buckets, voted_ids, has_more
+
+@app.route('/user')
+def user_dashboard():
+    if session.get('role') != 'user':
+        return redirect('/login')
+    page = max(request.args.get('page', 1, type=int), 1)
+    buckets, voted_ids, has_more = voter_elections(session['user_id'], page)
+    return render_template('user_dashboard.html', ongoing=buckets['ongoing'], expired=buckets['expired'],
+                           future=buckets['future'], voted=voted_ids, page=page, has_more=has_more)
+
+
+
+@app.route('/vote/<int:election_id>', methods=['GET','POST'])
+def vote(election_id):
+    if session.get('role')!='user':
+        return redirect('/login')
+    # Cached at login and updated by approve_user(), so no users lookup here
+    if not session.get('verified'):
+        flash("Awaiting admin approval.")
+        return redirect('/user')
+    election = get_election(election_id)
+    if election is None or election_state(election) != 'open':
+        flash("Election not active.")
+        return redirect('/user')
+    wait = vote_limiter.hit(('user', session['user_id']))
+    if wait:
+        return "Too many requests; please wait a moment.", 429, {'Retry-After': str(math.ceil(wait))}
+    if request.method=='POST':
+        try:
+            cid, ranks = read_ballot(election, request.form)
+        except ValueError as e:
+            flash(str(e))
+            return redirect(url_for('vote', election_id=election_id))
+        try:
+            with vote_admission.admit():
+                cast = cast_vote(session['user_id'], election, cid, ranks)
+        except ratelimit.Overloaded as e:
+            flash("Voting is busy right now; your vote was not recorded. Please try again in a moment.")
+            return (render_template('vote.html', election=election, candidate_list=candidate_list(election)),
+                    503, {'Retry-After': str(math.ceil(e.retry_after))})
+        if not cast:
+            flash("Already voted.")
+            return redirect('/user')
+        flash("Vote cast!")
+        return redirect('/user')
+    if votes_db(election).execute("SELECT 1 FROM votes WHERE user_id=? AND election_id=?", (session['user_id'], election_id)).fetchone():
+        flash("Already voted.")
+        return redirect('/user')
+    return render_template('vote.html', election=election, candidate_list=candidate_list(election))
+
+def result_context(election):
+    """What _result_table.html shows: a tabulation, or (name, votes) rows for plurality."""
+    election_id = election[0]
+    if election[8] != 'plurality':
+        return {'tabulation': tabulate_election(election), 'candidates': get_candidates(election_id),
+                'method_name': tabulate.METHODS[election[8]]}
+    if election[7]:
+        return {'result': snapshots.get(election_id).results()}
+    return {'result': votes_db(election).execute(
+        "SELECT candidates.name, SUM(tallies.count) as vote_count FROM tallies "
+        "JOIN candidates ON tallies.candidate_id = candidates.id "
+        "WHERE tallies.election_id = ? AND tallies.count > 0 "
+        "GROUP BY candidates.name", (election_id,)
+    ).fetchall()}
+
+@app.route('/result/<int:election_id>')
+def result(election_id):
+    if 'role' not in session:
+        return redirect('/login')
+
+    election = get_election(election_id)
+    if election is None:
+        return "Election not found.", 404
+    closed = election_closed(election)
+
+    # Check for normal users if election has ended
+    if session['role'] != 'admin' and not closed:
+        flash("Results are not available until the election ends.")
+        return redirect('/user')
+
+    load = lambda: result_context(election)
+    # A closed election's tallies no longer change, so its table is rendered once.
+    # Ranked counts rerun the whole tabulation, so while voting is open admins
+    # see one at most METADATA_CACHE_TTL seconds old instead of the live feed.
+    plurality = election[8] == 'plurality'
+    if closed or not plurality:
+        table = render_fragment(('result_table', election_id), '_result_table.html', load)
+    else:
+        table = Markup(render_template('_result_table.html', **load()))
+    return render_template('result.html', table=table, election=election, live=plurality and not closed)
+
+@app.route('/result/<int:election_id>/export')
+def export_result(election_id):
+    if 'role' not in session:
+        return redirect('/login')
+    fmt = request.args.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return f"Unsupported format {fmt!r}; use csv, xlsx or json.", 400
+    election = get_election(election_id)
+    if election is None:
+        return "Election not found.", 404
+    closed = election_closed(election)
+    if session['role'] != 'admin' and not closed:
+        flash("Results are not available until the election ends.")
+        return redirect('/user')
+
+    download_name = f"election_{election_id}_results.{fmt}"
+    conn = votes_db(election)
+    # Closed elections can no longer change, so their export is rendered once and reused
+    if closed:
+        path = export.artifact_path(app.config['EXPORT_FOLDER'], election_id, fmt)
+        if not os.path.exists(path):
+            if election[7]:
+                # archive_election() wrote every format before dropping the rows
+                return "The export of this archived election is missing.", 404
+            path = export.write_artifact(conn, election, fmt, app.config['EXPORT_FOLDER'], **export_counts(election))
+        return send_file(os.path.abspath(path), mimetype=export.FORMATS[fmt],
+                         as_attachment=True, download_name=download_name)
+    counts = export_counts(election)
+    if fmt == 'xlsx':
+        return send_file(io.BytesIO(export.build_xlsx(conn, election, **counts)), mimetype=export.FORMATS[fmt],
+                         as_attachment=True, download_name=download_name)
+    rows = (export.iter_csv if fmt == 'csv' else export.iter_json)(conn, election, **counts)
+    return Response(stream_with_context(rows), mimetype=export.FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'})
+
+@app.route('/admin/audit/<int:election_id>')
+def audit(election_id):
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    election = get_election(election_id)
+    if election is None:
+        return {'error': 'election not found'}, 404
+    vote_id = request.args.get('vote', type=int)
+    if vote_id is not None:
+        # O(log n) inclusion proof; check it offline with `python ledger.py proof.json`
+        proof = ledger.proof(votes_db(election), election_id, vote_id)
+        return proof if proof else ({'error': 'ballot not in the ledger'}, 404)
+    return audit_election(election, full=request.args.get('full') == '1')
+
+@app.route('/result/<int:election_id>/stream')
+def result_stream(election_id):
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    return Response(tally_feeds.stream(election_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+
+# JSON API for thin clients. It uses the same session cookie as the site (sign
+# in through /login) and the same checks as the pages it mirrors. GETs carry an
+# ETag; clients revalidating with If-None-Match get an empty 304 back.
+def election_json(election):
+    return {'id': election[0], 'title': election[1], 'opens': election[4], 'closes': election[5],
+            'timezone': election[10], 'state': election_state(election), 'method': election[8],
+            'seats': election[9]}
+
+def json_response(body, cache_key=None):
+    """``body()`` as compact JSON with an ETag; with ``cache_key`` the text is kept in metadata_cache."""
+    dump = lambda: json.dumps(body(), separators=(',', ':'))
+    text = metadata_cache.get_or_load(cache_key, dump) if cache_key else dump()
+    response = Response(text, mimetype='application/json')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/api/v1/elections')
+def api_elections():
+    if session.get('role') != 'user':
+        return {'error': 'sign in as a voter'}, 401
+    page = max(request.args.get('page', 1, type=int), 1)
+    buckets, voted_ids, has_more = voter_elections(session['user_id'], page)
+    return json_response(lambda: {
+        **{bucket: [{**election_json(get_election(e[0])), 'voted': e[0] in voted_ids} for e in rows]
+           for bucket, rows in buckets.items()},
+        'page': page, 'has_more': has_more})
+
+@app.route('/api/v1/elections/<int:election_id>/ballot', methods=['GET', 'POST'])
+def api_ballot(election_id):
+    """The ballot to fill in, or (POST {"marks": [candidate ids]}) cast it in one request.
+
+    Marks are in order of preference for ranked elections; a plurality
+    ballot has exactly one.
+    """
+    if session.get('role') != 'user':
+        return {'error': 'sign in as a voter'}, 401
+    election = get_election(election_id)
+    if election is None:
+        return {'error': 'election not found'}, 404
+    if request.method == 'GET':
+        voted = votes_db(election).execute("SELECT 1 FROM votes WHERE user_id=? AND election_id=?",
+                                           (session['user_id'], election_id)).fetchone() is not None
+        return json_response(lambda: {**election_json(election), 'voted': voted,
+                                      'candidates': [list(c[:3]) for c in get_candidates(election_id)]})
+    if not session.get('verified'):
+        return {'error': 'awaiting admin approval'}, 403
+    if election_state(election) != 'open':
+        return {'error': 'election not active'}, 409
+    wait = vote_limiter.hit(('user', session['user_id']))
+    if wait:
+        return {'error': 'too many requests'}, 429, {'Retry-After': str(math.ceil(wait))}
+    marks = (request.get_json(silent=True) or {}).get('marks')
+    try:
+        if not (isinstance(marks, list) and all(type(m) is int for m in marks)):
+            raise ValueError("Invalid ballot.")
+        cid, ranks = ballot_from_marks(election, marks)
+    except ValueError as e:
+        return {'error': str(e)}, 422
+    try:
+        with vote_admission.admit():
+            cast = cast_vote(session['user_id'], election, cid, ranks)
+    except ratelimit.Overloaded as e:
+        return {'error': 'busy; the ballot was not recorded'}, 503, {'Retry-After': str(math.ceil(e.retry_after))}
+    if not cast:
+        return {'error': 'already voted'}, 409
+    return {'voted': True}, 201
+
+@app.route('/api/v1/elections/<int:election_id>/results')
+def api_results(election_id):
+    if 'role' not in session:
+        return {'error': 'sign in'}, 401
+    election = get_election(election_id)
+    if election is None:
+        return {'error': 'election not found'}, 404
+    closed = election_closed(election)
+    if session['role'] != 'admin' and not closed:
+        return {'error': 'results are not available until the election ends'}, 403
+
+    def body():
+        context = result_context(election)
+        if 'tabulation' in context:
+            return {**election_json(election), 'tabulation': context['tabulation'],
+                    'candidates': [list(c[:3]) for c in context['candidates']]}
+        return {**election_json(election), 'results': [list(r) for r in context['result']]}
+    # Cached on the same terms as result()'s table
+    return json_response(body, ('result_json', election_id) if closed or election[8] != 'plurality' else None)
+
+@app.cli.command('check-tallies')
+@click.option('--election', type=int, default=None, help='Only check this election.')
+@click.option('--rebuild', is_flag=True, help='Recompute mismatched tallies from votes.')
+def check_tallies_command(election, rebuild):
+    """Compare the tallies table against votes and optionally rebuild it."""
+    conn = get_db()
+    # The main database, then each sharded election's own file
+    targets = [(conn, election)]
+    # Archived elections' shards are gone; opening one must not recreate it
+    sharded = conn.execute("SELECT id FROM elections WHERE sharded=1 AND archived=0"
+                           + (" AND id=?" if election else ""),
+                           (election,) if election else ()).fetchall()
+    targets += [(vote_shards.get_db(eid), eid) for (eid,) in sharded]
+    bad = False
+    for target, eid in targets:
+        rows = db.check_tallies(target, eid)
+        for row_eid, cid, tally, actual in rows:
+            click.echo(f"election {row_eid} candidate {cid}: tally={tally} votes={actual}")
+        if rows and rebuild:
+            db.rebuild_tallies(target, eid)
+        bad = bad or bool(rows)
+    if not bad:
+        click.echo("Tallies are consistent.")
+    elif rebuild:
+        click.echo("Tallies rebuilt.")
+
+@app.cli.command('archive-elections')
+@click.option('--election', type=int, default=None, help='Only archive this election.')
+@click.option('--no-compress', is_flag=True, help='Store snapshot columns uncompressed.')
+@click.option('--enable-incremental-vacuum', is_flag=True,
+              help='Switch an older database to incremental vacuum first (one full VACUUM).')
+def archive_elections_command(election, no_compress, enable_incremental_vacuum):
+    """Move closed elections' ballots into snapshot files and compact the database."""
+    conn = get_db()
+    if enable_incremental_vacuum:
+        db.enable_incremental_vacuum(conn)
+    ids = [election] if election else [r[0] for r in conn.execute(
+        "SELECT id FROM elections WHERE archived=0 ORDER BY id")]
+    done = [eid for eid in ids if archive_election(eid, compress=False if no_compress else None)]
+    click.echo(f"Archived {len(done)} election(s){': ' + ', '.join(map(str, done)) if done else ''}.")
+
+@app.cli.command('advance-elections')
+def advance_elections_command():
+    """Finalize elections past their close grace period (for cron when LIFECYCLE_SCHEDULER is off)."""
+    upcoming = election_lifecycle.tick()
+    click.echo("Next transition: " + (time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(upcoming))
+                                      if upcoming else "none scheduled") + ".")
+
+@app.cli.command('audit-ledger')
+@click.option('--election', type=int, default=None, help='Only audit this election.')
+@click.option('--full', is_flag=True, help='Rehash every record instead of resuming from the last checkpoint.')
+@click.option('--checkpoint', is_flag=True, help='Checkpoint each ledger that verifies cleanly.')
+@click.option('--backfill', is_flag=True, help='First start ledgers for ballots cast before they existed.')
+@click.option('--proof', 'vote_id', type=int, default=None, help='Print this ballot\'s inclusion proof as JSON.')
+def audit_ledger_command(election, full, checkpoint, backfill, vote_id):
+    """Verify the ballot ledgers against their checkpoints and the stored ballots."""
+    if vote_id is not None:
+        target = get_election(election) if election else None
+        proof = target and ledger.proof(votes_db(target), election, vote_id)
+        if not proof:
+            raise click.ClickException("No such ballot in that election's ledger (pass --election).")
+        click.echo(json.dumps(proof, indent=2))
+        return
+    ids = [election] if election else [r[0] for r in get_db().execute("SELECT id FROM elections ORDER BY id")]
+    bad = False
+    for eid in ids:
+        target = get_election(eid)
+        if target is None:
+            continue
+        conn = votes_db(target)
+        if backfill and not target[7]:
+            added = ledger.backfill(conn, eid)
+            if added:
+                click.echo(f"election {eid}: started its ledger with {added} earlier ballot(s)")
+        report = audit_election(target, full=full)
+        click.echo(f"election {eid}: {report['size']} record(s), root {report['root']}, "
+                   f"{report['rehashed']} rehashed from record {report['verified_from']}")
+        for message in report['errors']:
+            click.echo(f"  {message}", err=True)
+        if report['errors']:
+            bad = True
+        elif checkpoint:
+            with conn:
+                ledger.checkpoint(conn, eid)
+    if bad:
+        raise SystemExit(1)
+
+@app.cli.command('import-voters')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--verify', is_flag=True, help='Mark imported voters as verified.')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows per transaction.')
+def import_voters_command(path, verify, chunk_size):
+    """Bulk-register voters from a CSV or XLSX roll."""
+    with open(path, 'rb') as f:
+        inserted, errors = importer.import_voters(get_db(), f, path, verified=verify, chunksize=chunk_size,
+                                                  hash_passwords=password_hasher.hash_many)
+    for line_no, message in errors:
+        click.echo(f"line {line_no}: {message}", err=True)
+    click.echo(f"Imported {inserted} voters, {len(errors)} rows rejected.")
+
+@app.cli.command('hash-passwords')
+@click.option('--batch-size', default=500, show_default=True)
+def hash_passwords_command(batch_size):
+    """Hash passwords still stored in plaintext (logins also upgrade them one by one)."""
+    conn = get_db()
+    rows = [r for r in conn.execute("SELECT id, password FROM users WHERE password IS NOT NULL")
+            if not passwords.is_hashed(r[1])]
+    for i in range(0, len(rows), batch_size):
+        chunk = rows[i:i + batch_size]
+        hashes = password_hasher.hash_many([p for _, p in chunk])
+        with conn:
+            conn.executemany("UPDATE users SET password=? WHERE id=? AND password=?",
+                             [(h, uid, p) for (uid, p), h in zip(chunk, hashes)])
+    click.echo(f"Hashed {len(rows)} plaintext passwords.")
+
+@app.cli.command('migrate-uploads')
+@click.option('--delete', is_flag=True, help='Remove the legacy files once moved.')
+def migrate_uploads_command(delete):
+    """Move legacy static/uploads photos into the content-addressed store."""
+    conn = get_db()
+    rows = conn.execute("SELECT id, citizenship_photo, personal_photo FROM users").fetchall()
+    moved, keys, legacy = 0, set(), set()
+    for uid, *photos in rows:
+        new = []
+        for name in photos:
+            path = os.path.join(UPLOAD_FOLDER, name) if name and not storage.is_key(name) else None
+            if path and os.path.exists(path):
+                with open(path, 'rb') as f:
+                    name = blob_store.put(f.read(), name.rsplit('.', 1)[-1])
+                legacy.add(path)
+                keys.add(name)
+                moved += 1
+            new.append(name)
+        conn.execute("UPDATE users SET citizenship_photo=?, personal_photo=? WHERE id=?", (*new, uid))
+    conn.commit()
+    if delete:
+        for path in legacy:
+            os.remove(path)
+    click.echo(f"Moved {moved} photos into {len(keys)} unique blobs.")
+
+@app.route('/logout')
+def logout():
+    session.clear()
+    return redirect('/')
+
+if __name__ == '__main__':
+    configure_app()
+    app.run(debug=True)
@@ -0,0 +1,212 @@
+import hashlib, json, mmap, os, struct, sys, tempfile, threading, time, zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+# File layout: MAGIC, u32 header length, JSON header, zero padding to 8 bytes,
+# the column blobs at the offsets the header gives, then the SHA-256 of
+# everything before it. Columns are little-endian integer arrays in the
+# smallest array typecode that fits, optionally zlib-compressed. Ranked and
+# approval ballots add RANK_COLUMNS: each ballot's mark count and all marks
+# end to end. VOTER_COLUMN repeats the user ids sorted and never compressed,
+# so has_voter() can bisect the mapping.
+MAGIC = b'VOTESNAP'
+VERSION = 1
+COLUMNS = ('vote_id', 'user_id', 'candidate_id')
+RANK_COLUMNS = ('rank_count', 'rank')
+VOTER_COLUMN = 'voters'
+TYPECODES = ('b', 'h', 'i', 'q')
+_SWAP = sys.byteorder == 'big'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def path_for(folder, election_id):
+    return os.path.join(folder, f"election_{int(election_id)}.snap")
+
+
+def _pack(values, compress):
+    values = list(values)
+    lo, hi = min(values, default=0), max(values, default=0)
+    for typecode in TYPECODES:
+        bits = array(typecode).itemsize * 8
+        if -(1 << (bits - 1)) <= lo and hi < (1 << (bits - 1)):
+            break
+    data = array(typecode, values)
+    if _SWAP:
+        data.byteswap()
+    raw = data.tobytes()
+    if compress:
+        packed = zlib.compress(raw, 6)
+        if len(packed) < len(raw):
+            return typecode, 'zlib', packed
+    return typecode, 'raw', raw
+
+
+def write_snapshot(path, election, candidates, ballots, compress=True):
+    """Freeze an election into ``path``.
+
+    ``election`` is its row, ``candidates`` (id, name, party) rows and
+    ``ballots`` (vote_id, user_id, candidate_id[, ranks]) rows in vote_id
+    order, ``ranks`` being the encoded marks of a ranked or approval ballot.
+    The tallies are counted from the ballots themselves. Written to a temporary
+    file and renamed into place, so readers never see a partial snapshot.
+    """
+    columns = [[], [], []]
+    rank_count, rank = [], array('i')
+    counts = {c[0]: 0 for c in candidates}
+    for ballot in ballots:
+        for col, value in zip(columns, ballot[:3]):
+            col.append(value)
+        counts[ballot[2]] = counts.get(ballot[2], 0) + 1
+        marks = ballot[3] if len(ballot) > 3 else None
+        rank_count.append(len(marks) // 4 if marks else 0)
+        if marks:
+            rank.frombytes(marks)
+    names = COLUMNS
+    if len(rank):
+        if _SWAP:
+            rank.byteswap()  # the encoded marks are little-endian
+        names, columns = COLUMNS + RANK_COLUMNS, columns + [rank_count, rank]
+    blobs, layout, offset = [], {}, 0
+    for name, values in zip(names + (VOTER_COLUMN,), columns + [sorted(columns[1])]):
+        typecode, codec, blob = _pack(values, compress and name != VOTER_COLUMN)
+        layout[name] = {'typecode': typecode, 'codec': codec, 'count': len(values),
+                        'offset': offset, 'length': len(blob)}
+        blobs.append(blob)
+        offset += len(blob)
+    header = json.dumps({
+        'version': VERSION, 'created': int(time.time()),
+        'election': list(election[:4]),
+        'method': election[8] if len(election) > 8 else 'plurality',
+        'candidates': [list(c[:3]) for c in candidates],
+        'tallies': sorted(counts.items()),
+        'columns': layout,
+    }, separators=(',', ':')).encode()
+    prefix = MAGIC + struct.pack('<I', len(header)) + header
+    prefix += b'\0' * (-len(prefix) % 8)
+    digest = hashlib.sha256(prefix)
+    for blob in blobs:
+        digest.update(blob)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(prefix)
+            for blob in blobs:
+                f.write(blob)
+            f.write(digest.digest())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return path
+
+
+class Snapshot:
+    """A read-only, memory-mapped view of a snapshot file."""
+
+    def __init__(self, path, verify=True):
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            raise SnapshotError(f"{path}: missing") from None
+        if len(self.map) < len(MAGIC) + 4 + 32 or self.map[:len(MAGIC)] != MAGIC:
+            raise SnapshotError(f"{path}: not a vote snapshot")
+        if verify and hashlib.sha256(self.map[:-32]).digest() != self.map[-32:]:
+            raise SnapshotError(f"{path}: checksum mismatch")
+        (length,) = struct.unpack_from('<I', self.map, len(MAGIC))
+        start = len(MAGIC) + 4
+        self.header = json.loads(self.map[start:start + length])
+        if self.header['version'] != VERSION:
+            raise SnapshotError(f"{path}: unsupported version {self.header['version']}")
+        self.data_start = start + length + (-(start + length) % 8)
+        self.names = {c[0]: c[1] for c in self.header['candidates']}
+
+    @property
+    def election_id(self):
+        return self.header['election'][0]
+
+    def tallies(self):
+        """(candidate_id, count) for every candidate, including those with no votes."""
+        return [tuple(t) for t in self.header['tallies']]
+
+    def results(self):
+        """(name, votes) rows shaped like result()'s query: non-zero, grouped by name."""
+        totals = {}
+        for cid, count in self.tallies():
+            if count > 0:
+                name = self.names.get(cid, f"#{cid}")
+                totals[name] = totals.get(name, 0) + count
+        return sorted(totals.items())
+
+    def column(self, name):
+        """A column as an integer sequence: a zero-copy view of the mapping when stored raw."""
+        meta = self.header['columns'][name]
+        start = self.data_start + meta['offset']
+        blob = memoryview(self.map)[start:start + meta['length']]
+        if meta['codec'] == 'zlib':
+            blob = zlib.decompress(blob)
+        if _SWAP:
+            values = array(meta['typecode'], bytes(blob))
+            values.byteswap()
+            return values
+        return memoryview(blob).cast(meta['typecode'])
+
+    def ballots(self):
+        return zip(*(self.column(name) for name in COLUMNS))
+
+    def has_voter(self, user_id):
+        """Whether ``user_id`` cast one of the ballots: a binary search of the
+        sorted voter column, or a scan in snapshots written before it."""
+        if VOTER_COLUMN not in self.header['columns']:
+            return user_id in self.column('user_id')
+        voters = self.column(VOTER_COLUMN)
+        i = bisect_left(voters, user_id)
+        return i < len(voters) and voters[i] == user_id
+
+    def ranks(self):
+        """(lengths, flat) marks for tabulate.tabulate(), or None for a plurality election."""
+        if RANK_COLUMNS[1] not in self.header['columns']:
+            return None
+        return tuple(self.column(name) for name in RANK_COLUMNS)
+
+    def close(self):
+        self.map.close()
+
+
+class SnapshotCache:
+    """Keeps the most recently used snapshots mapped, verifying each on first open."""
+
+    def __init__(self, folder, maxsize=64):
+        self.folder = folder
+        self.maxsize = maxsize
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, election_id):
+        with self._lock:
+            snap = self._open.get(election_id)
+            if snap is None:
+                snap = self._open[election_id] = Snapshot(path_for(self.folder, election_id))
+                while len(self._open) > self.maxsize:
+                    # Unreferenced mappings are closed by the garbage collector
+                    self._open.popitem(last=False)
+            self._open.move_to_end(election_id)
+            return snap
+
+    def discard(self, election_id):
+        with self._lock:
+            self._open.pop(election_id, None)
+        try:
+            os.remove(path_for(self.folder, election_id))
+        except FileNotFoundError:
+            pass
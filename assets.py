@@ -0,0 +1,68 @@
+import gzip, hashlib, mimetypes, os
+from flask import Response, request, url_for
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+
+class Assets:
+    """Serves the files under the static folder at fingerprinted URLs.
+
+    Every file is read, hashed and (if worthwhile) gzipped once at startup;
+    ``asset_url('css/app.css')`` gives ``/assets/css/app.<hash>.css``, which
+    is served from memory with a one-year immutable Cache-Control, so a
+    changed file simply gets a new URL. Subfolders in ``exclude`` (user
+    uploads) are left to their own routes.
+    """
+
+    def __init__(self, app=None, exclude=('uploads',)):
+        self.exclude = set(exclude)
+        self.manifest = {}  # logical name -> fingerprinted name
+        self.files = {}     # fingerprinted name -> (mimetype, etag, body, gzipped body or None)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.build(app.static_folder)
+        app.add_url_rule('/assets/<path:name>', 'asset', self.serve)
+        app.add_template_global(self.url, 'asset_url')
+
+    def build(self, root):
+        for folder, dirs, files in os.walk(root):
+            if folder == root:
+                dirs[:] = [d for d in dirs if d not in self.exclude]
+            for fname in files:
+                path = os.path.join(folder, fname)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    body = f.read()
+                digest = hashlib.sha256(body).hexdigest()
+                stem, ext = os.path.splitext(name)
+                fingerprinted = f"{stem}.{digest[:12]}{ext}"
+                mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                gzipped = None
+                if mimetype.startswith(COMPRESSIBLE):
+                    gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+                    if len(gzipped) >= len(body):
+                        gzipped = None
+                self.manifest[name] = fingerprinted
+                self.files[fingerprinted] = (mimetype, digest, body, gzipped)
+
+    def url(self, name):
+        fingerprinted = self.manifest.get(name)
+        if fingerprinted is None:
+            return url_for('static', filename=name)
+        return url_for('asset', name=fingerprinted)
+
+    def serve(self, name):
+        entry = self.files.get(name)
+        if entry is None:
+            return "Not found", 404
+        mimetype, etag, body, gzipped = entry
+        headers = {'Cache-Control': 'public, max-age=31536000, immutable', 'Vary': 'Accept-Encoding'}
+        if gzipped is not None and request.accept_encodings['gzip']:
+            body = gzipped
+            etag += '-gz'
+            headers['Content-Encoding'] = 'gzip'
+        response = Response(body, mimetype=mimetype, headers=headers)
+        response.set_etag(etag)
+        return response.make_conditional(request)
@@ -0,0 +1,259 @@
+"""Load-test the voting flow against a throwaway database.
+
+    python benchmark.py --votes 100000 --requests 2000 --concurrency 16
+    python benchmark.py --mode server --out baseline.json
+    python benchmark.py --compare baseline.json
+    python benchmark.py --scenarios login --password-method pbkdf2:sha256:600000
+
+Seeds a synthetic electorate, drives the real Flask routes either through
+the test client or a local threaded WSGI server, and reports latency
+percentiles and throughput per endpoint. --out saves the report as JSON;
+--compare prints the change against a saved report.
+"""
+import argparse, json, logging, math, os, random, secrets, sys, tempfile, threading, time
+import http.cookiejar, urllib.error, urllib.parse, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+SCENARIOS = ('vote', 'api_vote', 'result', 'dashboard', 'login')
+
+
+def seed(conn, voters, votes, candidates, elections, password):
+    """Fill an empty database: ``votes`` ballots already cast in election 1 and
+    ``voters`` verified users who have not voted yet, all with the password
+    hash ``password``."""
+    today = date.today()
+    conn.executemany("INSERT INTO elections(title, start_date, end_date) VALUES(?,?,?)",
+                     [(f"Election {i}", str(today - timedelta(days=1)), str(today + timedelta(days=1)))
+                      for i in range(1, elections + 1)])
+    conn.executemany("INSERT INTO candidates(name, party, election_id) VALUES(?,?,?)",
+                     [(f"Candidate {e}-{i}", f"Party {i % 5}", e)
+                      for e in range(1, elections + 1) for i in range(candidates)])
+    total = votes + voters
+    conn.executemany("INSERT INTO users(username,password,name,dob,citizenship_id,verified) VALUES(?,?,?,?,?,1)",
+                     ((f"bench{i}", password, f"Voter {i}", "1990-01-01", f"BC{i}") for i in range(total)))
+    first_uid = conn.execute("SELECT id FROM users WHERE username='bench0'").fetchone()[0]
+    rng = random.Random(42)
+    conn.executemany("INSERT INTO votes(user_id, candidate_id, election_id) VALUES(?,?,1)",
+                     ((first_uid + i, rng.randint(1, candidates)) for i in range(votes)))
+    conn.commit()
+    return [(first_uid + i, f"bench{i}") for i in range(votes, total)]
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples, errors, elapsed):
+    ms = [s * 1000 for s in samples]
+    return {
+        'requests': len(samples), 'errors': errors,
+        'throughput_rps': round(len(samples) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(ms, 50), 2) if ms else None,
+        'p95_ms': round(percentile(ms, 95), 2) if ms else None,
+        'p99_ms': round(percentile(ms, 99), 2) if ms else None,
+        'max_ms': round(max(ms), 2) if ms else None,
+    }
+
+
+class ClientDriver:
+    """Drives the app in-process through Flask's test client."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def session(self, user, role):
+        client = self.app.test_client()
+        with client.session_transaction() as s:
+            s.update(user_id=user[0], username=user[1], role=role, verified=True, logged_in=True)
+        return client
+
+    def anonymous(self):
+        return self.app.test_client()
+
+    def request(self, client, method, path, data=None, json_body=None):
+        resp = client.open(path, method=method, data=data, json=json_body)
+        resp.close()
+        return resp.status_code
+
+
+class ServerDriver:
+    """Drives the app over HTTP through a local threaded WSGI server.
+
+    Sessions are written straight into the server-side store, so setting up
+    thousands of voters does not pay for thousands of password checks; the
+    login scenario measures those on its own.
+    """
+
+    def __init__(self, app, store):
+        self.store = store
+        self.cookie = app.config['SESSION_COOKIE_NAME']
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def session(self, user, role):
+        sid = secrets.token_urlsafe(32)
+        self.store.save(sid, {'user_id': user[0], 'username': user[1], 'role': role,
+                              'verified': True, 'logged_in': True}, user[0])
+        client = urllib.request.build_opener(NoRedirect())
+        client.addheaders.append(('Cookie', f"{self.cookie}={sid}"))
+        return client
+
+    def anonymous(self):
+        return urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                           NoRedirect())
+
+    def request(self, client, method, path, data=None, json_body=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base + path, data=body if method == 'POST' else None)
+        if json_body is not None:
+            req.data = json.dumps(json_body).encode()
+            req.add_header('Content-Type', 'application/json')
+        try:
+            with client.open(req, timeout=60) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def close(self):
+        self.server.shutdown()
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Report the 302 itself rather than timing the page it points to
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def run_scenario(driver, name, users, admin, requests, concurrency, candidates):
+    if name in ('vote', 'api_vote'):
+        sessions = [driver.session(user, 'user') for user in users[:requests]]
+    elif name == 'dashboard':
+        sessions = [driver.session(user, 'user') for user in users[:max(1, concurrency * 4)]]
+    elif name == 'login':
+        sessions = [driver.anonymous() for _ in range(concurrency)]
+    else:
+        sessions = [driver.session(admin, 'admin') for _ in range(concurrency)]
+
+    samples, errors, lock = [], [0], threading.Lock()
+    rng = random.Random(7)
+
+    def one(i):
+        client = sessions[i % len(sessions)]
+        if name == 'vote':
+            args = ('POST', '/vote/1', {'candidate': rng.randint(1, candidates)})
+        elif name == 'api_vote':
+            # Election 2, so the same voters are still free to vote; one round trip, no redirect
+            args = ('POST', '/api/v1/elections/2/ballot', None, {'marks': [candidates + rng.randint(1, candidates)]})
+        elif name == 'result':
+            args = ('GET', '/result/1', None)
+        elif name == 'login':
+            args = ('POST', '/login', {'username': users[i % len(users)][1], 'password': 'pw'})
+        else:
+            args = ('GET', '/user', None)
+        start = time.perf_counter()
+        status = driver.request(client, *args)
+        took = time.perf_counter() - start
+        with lock:
+            samples.append(took)
+            if status >= 400:
+                errors[0] += 1
+
+    count = min(requests, len(sessions)) if name in ('vote', 'api_vote') else requests
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        list(ex.map(one, range(count)))
+    return summarize(samples, errors[0], time.perf_counter() - start)
+
+
+def compare(current, baseline):
+    for name, stats in current['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if not old:
+            continue
+        parts = []
+        for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            if old.get(key) and stats.get(key) is not None:
+                parts.append(f"{key} {old[key]} -> {stats[key]} ({(stats[key] - old[key]) / old[key]:+.1%})")
+        print(f"{name:>10}: " + ", ".join(parts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--votes', type=int, default=10000, help='ballots already cast before the run')
+    parser.add_argument('--voters', type=int, default=None, help='fresh voters available to vote (default: --requests)')
+    parser.add_argument('--candidates', type=int, default=8)
+    parser.add_argument('--elections', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--mode', choices=('client', 'server'), default='client')
+    parser.add_argument('--group-commit', action='store_true', help='enable write-behind group commit for votes')
+    parser.add_argument('--synchronous', choices=('OFF', 'NORMAL', 'FULL'), default='NORMAL',
+                        help='PRAGMA synchronous for request connections (ballots are always committed with FULL)')
+    parser.add_argument('--password-method', default=None,
+                        help='werkzeug hash method and cost for seeded users (default: the app setting)')
+    parser.add_argument('--out', help='write the report to this JSON file')
+    parser.add_argument('--compare', help='compare against a previously saved JSON report')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='voting-bench-')
+    logging.getLogger('voting.metrics').setLevel(logging.ERROR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as voting
+    import db, ledger
+
+    voting.configure_app({
+        'DATABASE': os.path.join(workdir, 'bench.db'),
+        'EXPORT_FOLDER': os.path.join(workdir, 'exports'),
+        'BLOB_FOLDER': os.path.join(workdir, 'blobs'),
+        'SESSION_DATABASE': os.path.join(workdir, 'sessions.db'),
+        'VOTE_GROUP_COMMIT': args.group_commit,
+        'DB_SYNCHRONOUS': args.synchronous,
+        'LOGIN_BURST': 10 ** 9,
+        **({'PASSWORD_METHOD': args.password_method} if args.password_method else {}),
+    })
+    from werkzeug.security import generate_password_hash
+    conn = db.get_pool(voting.app).connect()
+    t0 = time.perf_counter()
+    # One hash shared by every seeded voter; hashing each would dominate the setup time
+    password = generate_password_hash('pw', voting.app.config['PASSWORD_METHOD'])
+    users = seed(conn, args.voters or args.requests, args.votes, args.candidates, args.elections, password)
+    db.rebuild_tallies(conn)
+    ledger.backfill(conn, 1)
+    admin = conn.execute("SELECT id, username FROM users WHERE username='admin'").fetchone()
+    conn.close()
+    print(f"seeded {args.votes} votes and {len(users)} fresh voters in {time.perf_counter() - t0:.1f}s ({workdir})")
+
+    driver = ServerDriver(voting.app, voting.session_store) if args.mode == 'server' else ClientDriver(voting.app)
+    cores = min(voting.app.config['PASSWORD_WORKERS'], os.cpu_count() or 1)
+
+    report = {'mode': args.mode, 'config': vars(args), 'results': {}}
+    for name in args.scenarios.split(','):
+        stats = run_scenario(driver, name, users, admin, args.requests, args.concurrency, args.candidates)
+        if name == 'login' and stats['throughput_rps']:
+            stats['per_core_rps'] = round(stats['throughput_rps'] / cores, 1)
+        report['results'][name] = stats
+        print(f"{name:>10}: {stats['requests']} req, {stats['errors']} err, {stats['throughput_rps']} req/s, "
+              f"p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms, p99 {stats['p99_ms']} ms"
+              + (f", {stats['per_core_rps']} logins/s per core ({cores} cores)" if 'per_core_rps' in stats else ''))
+    if args.mode == 'server':
+        driver.close()
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
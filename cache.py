@@ -0,0 +1,91 @@
+import threading, time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ``ttl`` seconds.
+
+    The TTL bounds how stale another worker process can be after an admin
+    edit; within a process, writes call ``invalidate`` directly. Each key
+    being loaded has a generation that ``invalidate`` bumps, so a load that
+    read the old data does not store it after the invalidation.
+    """
+
+    def __init__(self, maxsize=256, ttl=30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = {}  # key -> [loads in flight, generation]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            loading = self._loading.setdefault(key, [0, 0])
+            loading[0] += 1
+            generation = loading[1]
+        try:
+            value = loader()
+        except BaseException:
+            with self._lock:
+                self._done_loading(key, loading)
+            raise
+        with self._lock:
+            if loading[1] == generation:
+                self._store(key, value)
+            self._done_loading(key, loading)
+        return value
+
+    def _done_loading(self, key, loading):
+        loading[0] -= 1
+        if not loading[0]:
+            del self._loading[key]
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                if key in self._loading:
+                    self._loading[key][1] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            for loading in self._loading.values():
+                loading[1] += 1
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,490 @@
+import os, sqlite3, threading, queue, time
+from urllib.request import pathname2url
+import ledger
+from flask import current_app, g
+
+DEFAULT_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA temp_store=MEMORY",
+)
+
+_pool_lock = threading.Lock()
+
+# Callables run as hook(sql, seconds) after every statement on a pooled
+# connection; metrics.py registers one to count and time queries.
+query_hooks = []
+
+
+def _report(sql, started):
+    took = time.perf_counter() - started
+    for hook in query_hooks:
+        hook(sql, took)
+
+
+class TimedCursor(sqlite3.Cursor):
+    # Times the execute step only; rows fetched afterwards are not included.
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _report(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _report(sql, started)
+
+    def executescript(self, sql_script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            _report(sql_script, started)
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+# Schema migrations, applied in order. The list index + 1 is the version
+# stored in PRAGMA user_version; never edit a shipped entry, append a new one.
+MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      username TEXT UNIQUE,
+      password TEXT,
+      name TEXT,
+      dob TEXT,
+      citizenship_id TEXT,
+      citizenship_photo TEXT,
+      personal_photo TEXT,
+      verified INTEGER DEFAULT 0,
+      role TEXT DEFAULT 'user'
+    );
+    CREATE TABLE IF NOT EXISTS elections (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      title TEXT,
+      start_date TEXT,
+      end_date TEXT
+    );
+    CREATE TABLE IF NOT EXISTS candidates (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      name TEXT,
+      party TEXT,
+      election_id INTEGER,
+      FOREIGN KEY(election_id) REFERENCES elections(id)
+    );
+    CREATE TABLE IF NOT EXISTS votes (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER,
+      candidate_id INTEGER,
+      election_id INTEGER
+    );
+    """,
+    # One ballot per user per election is enforced by the unique index, so any
+    # duplicates left over from the old SELECT-then-INSERT check must go first.
+    # The first ballot stays; the later ones are kept in votes_quarantine for
+    # an administrator to review (init_db() logs how many).
+    """
+    CREATE TABLE IF NOT EXISTS votes_quarantine AS
+      SELECT * FROM votes WHERE id NOT IN (
+        SELECT MIN(id) FROM votes GROUP BY user_id, election_id
+      );
+    DELETE FROM votes WHERE id IN (SELECT id FROM votes_quarantine);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_votes_user_election ON votes(user_id, election_id);
+    CREATE INDEX IF NOT EXISTS idx_votes_election_candidate ON votes(election_id, candidate_id);
+    CREATE INDEX IF NOT EXISTS idx_votes_candidate ON votes(candidate_id);
+    CREATE INDEX IF NOT EXISTS idx_candidates_election ON candidates(election_id);
+    """,
+    # Running per-candidate counts, kept in step with votes by record_vote().
+    """
+    CREATE TABLE IF NOT EXISTS tallies (
+      election_id INTEGER NOT NULL,
+      candidate_id INTEGER NOT NULL,
+      count INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY(election_id, candidate_id)
+    ) WITHOUT ROWID;
+    INSERT OR REPLACE INTO tallies(election_id, candidate_id, count)
+      SELECT election_id, candidate_id, COUNT(*) FROM votes GROUP BY election_id, candidate_id;
+    """,
+    # Keyset pagination and lookups on the verify_users page.
+    """
+    CREATE INDEX IF NOT EXISTS idx_users_role_verified ON users(role, verified, id);
+    CREATE INDEX IF NOT EXISTS idx_users_citizenship ON users(citizenship_id);
+    """,
+    # Filled in by the background image pipeline after registration.
+    """
+    ALTER TABLE users ADD COLUMN photos_status TEXT DEFAULT 'pending';
+    ALTER TABLE users ADD COLUMN citizenship_thumb TEXT;
+    ALTER TABLE users ADD COLUMN citizenship_width INTEGER;
+    ALTER TABLE users ADD COLUMN citizenship_height INTEGER;
+    ALTER TABLE users ADD COLUMN citizenship_sha256 TEXT;
+    ALTER TABLE users ADD COLUMN personal_thumb TEXT;
+    ALTER TABLE users ADD COLUMN personal_width INTEGER;
+    ALTER TABLE users ADD COLUMN personal_height INTEGER;
+    ALTER TABLE users ADD COLUMN personal_sha256 TEXT;
+    """,
+    # Sortable epoch-second copies of the election dates (local midnight, the
+    # same instant the ISO string comparisons used), kept in sync by triggers.
+    """
+    ALTER TABLE elections ADD COLUMN start_ts INTEGER;
+    ALTER TABLE elections ADD COLUMN end_ts INTEGER;
+    UPDATE elections SET start_ts = CAST(strftime('%s', start_date, 'utc') AS INTEGER),
+                         end_ts = CAST(strftime('%s', end_date, 'utc') AS INTEGER);
+    CREATE TRIGGER IF NOT EXISTS elections_ts_insert AFTER INSERT ON elections BEGIN
+      UPDATE elections SET start_ts = CAST(strftime('%s', NEW.start_date, 'utc') AS INTEGER),
+                           end_ts = CAST(strftime('%s', NEW.end_date, 'utc') AS INTEGER)
+      WHERE id = NEW.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS elections_ts_update AFTER UPDATE OF start_date, end_date ON elections BEGIN
+      UPDATE elections SET start_ts = CAST(strftime('%s', NEW.start_date, 'utc') AS INTEGER),
+                           end_ts = CAST(strftime('%s', NEW.end_date, 'utc') AS INTEGER)
+      WHERE id = NEW.id;
+    END;
+    CREATE INDEX IF NOT EXISTS idx_elections_start_ts ON elections(start_ts);
+    CREATE INDEX IF NOT EXISTS idx_elections_end_ts ON elections(end_ts);
+    """,
+    # Server-side sessions (sessions.SQLiteSessionStore)
+    """
+    CREATE TABLE IF NOT EXISTS sessions(
+      sid TEXT PRIMARY KEY,
+      user_id INTEGER,
+      data TEXT NOT NULL,
+      expires REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id);
+    CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires);
+    """,
+    # Elections created with VOTE_SHARDS on keep their ballots in a shard file (shards.py).
+    """
+    ALTER TABLE elections ADD COLUMN sharded INTEGER NOT NULL DEFAULT 0;
+    """,
+    # Set once an election's ballots have moved into a snapshot file (archive.py).
+    """
+    ALTER TABLE elections ADD COLUMN archived INTEGER NOT NULL DEFAULT 0;
+    """,
+    # Counting method and seats (tabulate.py). Ranked and approval ballots keep
+    # every mark in votes.ranks; candidate_id stays the first one.
+    """
+    ALTER TABLE elections ADD COLUMN method TEXT NOT NULL DEFAULT 'plurality';
+    ALTER TABLE elections ADD COLUMN seats INTEGER NOT NULL DEFAULT 1;
+    ALTER TABLE votes ADD COLUMN ranks BLOB;
+    """,
+    # Append-only ballot ledger (ledger.py). Rows can only be deleted once
+    # their election has been.
+    """
+    CREATE TABLE IF NOT EXISTS ledger (
+      election_id INTEGER NOT NULL,
+      seq INTEGER NOT NULL,
+      kind TEXT NOT NULL,
+      vote_id INTEGER NOT NULL,
+      user_id INTEGER,
+      candidate_id INTEGER,
+      ranks BLOB,
+      leaf BLOB NOT NULL,
+      PRIMARY KEY(election_id, seq)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_ledger_vote ON ledger(election_id, vote_id);
+    CREATE TABLE IF NOT EXISTS ledger_nodes (
+      election_id INTEGER NOT NULL,
+      level INTEGER NOT NULL,
+      idx INTEGER NOT NULL,
+      hash BLOB NOT NULL,
+      PRIMARY KEY(election_id, level, idx)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+      election_id INTEGER NOT NULL,
+      size INTEGER NOT NULL,
+      root BLOB NOT NULL,
+      frontier BLOB NOT NULL,
+      created REAL NOT NULL,
+      PRIMARY KEY(election_id, size)
+    ) WITHOUT ROWID;
+    CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON ledger
+    BEGIN SELECT RAISE(ABORT, 'the ballot ledger is append-only'); END;
+    CREATE TRIGGER IF NOT EXISTS ledger_nodes_no_update BEFORE UPDATE ON ledger_nodes
+    BEGIN SELECT RAISE(ABORT, 'the ballot ledger is append-only'); END;
+    CREATE TRIGGER IF NOT EXISTS ledger_checkpoints_no_update BEFORE UPDATE ON ledger_checkpoints
+    BEGIN SELECT RAISE(ABORT, 'the ballot ledger is append-only'); END;
+    CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON ledger
+    WHEN EXISTS (SELECT 1 FROM elections WHERE id = OLD.election_id)
+    BEGIN SELECT RAISE(ABORT, 'the ballot ledger is append-only'); END;
+    CREATE TRIGGER IF NOT EXISTS ledger_nodes_no_delete BEFORE DELETE ON ledger_nodes
+    WHEN EXISTS (SELECT 1 FROM elections WHERE id = OLD.election_id)
+    BEGIN SELECT RAISE(ABORT, 'the ballot ledger is append-only'); END;
+    CREATE TRIGGER IF NOT EXISTS ledger_checkpoints_no_delete BEFORE DELETE ON ledger_checkpoints
+    WHEN EXISTS (SELECT 1 FROM elections WHERE id = OLD.election_id)
+    BEGIN SELECT RAISE(ABORT, 'the ballot ledger is append-only'); END;
+    """,
+    # Elections open and close at exact instants (lifecycle.py). A bare end
+    # date now runs to the end of that day instead of closing at its first
+    # second. The app writes start_ts/end_ts in the election's timezone; the
+    # triggers only fill them in, in server-local time, for rows that arrive
+    # without them. state trails the instants and is advanced by the scheduler.
+    """
+    DROP TRIGGER IF EXISTS elections_ts_insert;
+    DROP TRIGGER IF EXISTS elections_ts_update;
+    ALTER TABLE elections ADD COLUMN timezone TEXT;
+    ALTER TABLE elections ADD COLUMN state TEXT NOT NULL DEFAULT 'draft';
+    UPDATE elections SET end_ts = CAST(strftime('%s', end_date, '+1 day', 'utc') AS INTEGER) WHERE length(end_date) = 10;
+    UPDATE elections SET state = CASE WHEN end_ts <= CAST(strftime('%s', 'now') AS INTEGER) THEN 'closed'
+                                      WHEN start_ts <= CAST(strftime('%s', 'now') AS INTEGER) THEN 'open'
+                                      ELSE 'draft' END;
+    CREATE TRIGGER IF NOT EXISTS elections_ts_insert AFTER INSERT ON elections
+    WHEN NEW.start_ts IS NULL OR NEW.end_ts IS NULL BEGIN
+      UPDATE elections SET start_ts = coalesce(NEW.start_ts, CAST(strftime('%s', NEW.start_date, 'utc') AS INTEGER)),
+                           end_ts = coalesce(NEW.end_ts, CAST(strftime('%s', NEW.end_date, CASE WHEN length(NEW.end_date) = 10 THEN '+1 day' ELSE '+0 days' END, 'utc') AS INTEGER))
+      WHERE id = NEW.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS elections_ts_update AFTER UPDATE OF start_date, end_date ON elections BEGIN
+      UPDATE elections SET
+        start_ts = CASE WHEN NEW.start_date IS NOT OLD.start_date AND NEW.start_ts IS OLD.start_ts
+                        THEN CAST(strftime('%s', NEW.start_date, 'utc') AS INTEGER) ELSE NEW.start_ts END,
+        end_ts = CASE WHEN NEW.end_date IS NOT OLD.end_date AND NEW.end_ts IS OLD.end_ts
+                      THEN CAST(strftime('%s', NEW.end_date, CASE WHEN length(NEW.end_date) = 10 THEN '+1 day' ELSE '+0 days' END, 'utc') AS INTEGER) ELSE NEW.end_ts END,
+        state = 'draft'
+      WHERE id = NEW.id;
+    END;
+    """,
+    # Sessions moved to a database file of their own (sessions.SQLiteSessionStore)
+    """
+    DROP TABLE IF EXISTS sessions;
+    """,
+    # Raw uploads replaced by their cleaned copy, deleted by images.ImagePipeline
+    # once nothing has referenced them for its grace period
+    """
+    CREATE TABLE IF NOT EXISTS blob_garbage (
+      key TEXT PRIMARY KEY,
+      since REAL NOT NULL
+    ) WITHOUT ROWID;
+    """,
+    # A process finalizing an election holds it in state 'closing' until
+    # claimed_until; after that (a crash, or a failed hook) it is retried
+    """
+    ALTER TABLE elections ADD COLUMN claimed_until REAL;
+    """,
+    # Voter-roll imports run in the background (importer.ImportJobs); any
+    # worker can report a job's progress from its row
+    """
+    CREATE TABLE IF NOT EXISTS import_jobs (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      filename TEXT NOT NULL,
+      status TEXT NOT NULL DEFAULT 'queued',
+      inserted INTEGER NOT NULL DEFAULT 0,
+      rejected INTEGER NOT NULL DEFAULT 0,
+      errors TEXT,
+      message TEXT,
+      created REAL NOT NULL,
+      finished REAL
+    );
+    """,
+]
+
+
+class PoolExhausted(Exception):
+    """Every connection stayed checked out for the whole busy timeout."""
+
+
+class ConnectionPool:
+    """A small bounded pool of SQLite connections shared by all request threads.
+
+    Connections are opened lazily up to ``size`` and handed back after each
+    request, so the open, schema parse and per-connection statement cache are
+    paid once per connection instead of once per request.
+    """
+
+    def __init__(self, path, size=8, busy_timeout=5000, cached_statements=256, synchronous='NORMAL',
+                 create=True):
+        self.path = path
+        self.create = create
+        self.synchronous = synchronous
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        # Without ``create`` a missing file is an error instead of a new empty database
+        target = self.path if self.create else f"file:{pathname2url(os.path.abspath(self.path))}?mode=rw"
+        conn = sqlite3.connect(target, timeout=self.busy_timeout / 1000, uri=not self.create,
+                               check_same_thread=False, factory=TimedConnection,
+                               cached_statements=self.cached_statements)
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        for pragma in DEFAULT_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                try:
+                    return self.connect()
+                except Exception:
+                    self._opened -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=self.busy_timeout / 1000)
+        except queue.Empty:
+            raise PoolExhausted(self.path) from None
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._opened = 0
+
+
+def _statements(script):
+    buf = ''
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            yield buf
+            buf = ''
+    if buf.strip():
+        yield buf
+
+
+def migrate(conn):
+    # A new file starts with auto_vacuum=INCREMENTAL (free while it is empty);
+    # older files are switched by enable_incremental_vacuum() on request.
+    if not conn.execute("SELECT 1 FROM sqlite_master").fetchone():
+        enable_incremental_vacuum(conn)
+    # BEGIN IMMEDIATE takes the write lock before reading user_version, so
+    # several workers starting at once apply each migration exactly once.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for v, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in _statements(script):
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version={v}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return version, len(MIGRATIONS)
+
+
+def enable_incremental_vacuum(conn):
+    """Switch an existing database to auto_vacuum=INCREMENTAL (rewrites the whole file once)."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+def incremental_vacuum(conn, pages=0):
+    """Return up to ``pages`` free pages (all if 0) to the filesystem; returns how many
+    were free. A no-op unless the database uses auto_vacuum=INCREMENTAL."""
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        # executescript steps the pragma to completion; a cursor stops after one page
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+    return free
+
+
+def record_vote(conn, user_id, election_id, candidate_id, ranks=None):
+    """Insert a ballot, bump its tally and append it to the ledger; the caller
+    owns the transaction.
+
+    ``ranks`` is the encoded ballot of a ranked or approval election.
+    Raises sqlite3.IntegrityError if the user already voted in the election.
+    """
+    vote_id = conn.execute("INSERT INTO votes(user_id,candidate_id,election_id,ranks) VALUES(?,?,?,?)",
+                           (user_id, candidate_id, election_id, ranks)).lastrowid
+    conn.execute("""
+        INSERT INTO tallies(election_id, candidate_id, count) VALUES(?,?,1)
+        ON CONFLICT(election_id, candidate_id) DO UPDATE SET count=count+1
+    """, (election_id, candidate_id))
+    ledger.append(conn, election_id, 'vote', vote_id, user_id, candidate_id, ranks)
+
+
+def check_tallies(conn, election_id=None):
+    """Return (election_id, candidate_id, tally, actual) rows that disagree with votes."""
+    where, args = ("WHERE election_id=?", (election_id,)) if election_id is not None else ("", ())
+    return conn.execute(f"""
+        SELECT election_id, candidate_id, SUM(tally), SUM(actual) FROM (
+          SELECT election_id, candidate_id, count AS tally, 0 AS actual FROM tallies {where}
+          UNION ALL
+          SELECT election_id, candidate_id, 0, COUNT(*) FROM votes {where}
+          GROUP BY election_id, candidate_id
+        )
+        GROUP BY election_id, candidate_id
+        HAVING SUM(tally) != SUM(actual)
+    """, args + args).fetchall()
+
+
+def rebuild_tallies(conn, election_id=None):
+    where, args = ("WHERE election_id=?", (election_id,)) if election_id is not None else ("", ())
+    with conn:
+        conn.execute(f"DELETE FROM tallies {where}", args)
+        conn.execute(f"""
+            INSERT INTO tallies(election_id, candidate_id, count)
+            SELECT election_id, candidate_id, COUNT(*) FROM votes {where}
+            GROUP BY election_id, candidate_id
+        """, args)
+
+
+def get_pool(app=None):
+    app = app or current_app
+    pool = app.extensions.get('db_pool')
+    if pool is None:
+        with _pool_lock:
+            pool = app.extensions.get('db_pool')
+            if pool is None:
+                pool = ConnectionPool(app.config['DATABASE'],
+                                      size=app.config['DB_POOL_SIZE'],
+                                      busy_timeout=app.config['DB_BUSY_TIMEOUT_MS'],
+                                      synchronous=app.config['DB_SYNCHRONOUS'])
+                app.extensions['db_pool'] = pool
+    return pool
+
+
+def get_db():
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+
+def release_db(exc=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+
+
+def init_app(app):
+    app.config.setdefault('DATABASE', 'voting.db')
+    app.config.setdefault('DB_POOL_SIZE', 8)
+    app.config.setdefault('DB_BUSY_TIMEOUT_MS', 5000)
+    # NORMAL in WAL mode can lose the last commits on power failure; FULL fsyncs every commit
+    app.config.setdefault('DB_SYNCHRONOUS', 'NORMAL')
+    app.teardown_appcontext(release_db)
@@ -0,0 +1,173 @@
+import csv, io, json, os
+import pandas as pd
+
+FORMATS = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def candidate_rows(conn, election_id):
+    return conn.execute("""
+        SELECT c.name, c.party, COALESCE(t.count, 0)
+        FROM candidates c
+        LEFT JOIN tallies t ON t.election_id = c.election_id AND t.candidate_id = c.id
+        WHERE c.election_id = ?
+        ORDER BY 3 DESC, c.name
+    """, (election_id,))
+
+
+def party_rows(conn, election_id):
+    return conn.execute("""
+        SELECT c.party, SUM(COALESCE(t.count, 0))
+        FROM candidates c
+        LEFT JOIN tallies t ON t.election_id = c.election_id AND t.candidate_id = c.id
+        WHERE c.election_id = ?
+        GROUP BY c.party
+        ORDER BY 2 DESC, c.party
+    """, (election_id,))
+
+
+def turnout(conn, election_id):
+    votes = conn.execute("SELECT COALESCE(SUM(count), 0) FROM tallies WHERE election_id=?",
+                         (election_id,)).fetchone()[0]
+    eligible = conn.execute("SELECT COUNT(*) FROM users WHERE role='user' AND verified=1").fetchone()[0]
+    return {'votes': votes, 'eligible': eligible,
+            'rate': round(votes / eligible, 4) if eligible else None}
+
+
+def round_rows(tabulation, candidates):
+    """(name, party, per-round counts, elected) for each candidate of a ranked or
+    approval count; ``candidates`` are the rows tabulate() was given ids of."""
+    elected = set(tabulation['elected'])
+    for i, c in enumerate(candidates):
+        yield c[1], c[2], [r['counts'][i] for r in tabulation['rounds']], i in elected
+
+
+def round_labels(tabulation):
+    rounds = tabulation['rounds']
+    return ['votes'] if len(rounds) == 1 else [f'round {n}' for n in range(1, len(rounds) + 1)]
+
+
+def iter_csv(conn, election, tabulation=None, candidates=()):
+    """The export as CSV. For ranked and approval elections pass their
+    ``tabulation``; the tallies only hold each ballot's first mark."""
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    def flush():
+        data = out.getvalue()
+        out.seek(0)
+        out.truncate()
+        return data
+
+    if tabulation is not None:
+        labels = round_labels(tabulation)
+        writer.writerow(['type', 'name', 'party'] + labels + ['elected'])
+        yield flush()
+        for name, party, counts, elected in round_rows(tabulation, candidates):
+            writer.writerow(['candidate', name, party] + ['' if v is None else v for v in counts]
+                            + ['yes' if elected else ''])
+            yield flush()
+        if tabulation['method'] in ('irv', 'stv'):
+            writer.writerow(['exhausted', '', ''] + [r['exhausted'] for r in tabulation['rounds']] + [''])
+        writer.writerow(['ballots', '', '', tabulation['ballots']])
+        if tabulation['quota'] is not None:
+            writer.writerow(['quota', '', '', tabulation['quota']])
+        t = turnout(conn, election[0])
+        writer.writerow(['turnout', 'verified voters', '', t['eligible']])
+        yield flush()
+        return
+    writer.writerow(['type', 'name', 'party', 'votes'])
+    yield flush()
+    for name, party, votes in candidate_rows(conn, election[0]):
+        writer.writerow(['candidate', name, party, votes])
+        yield flush()
+    for party, votes in party_rows(conn, election[0]):
+        writer.writerow(['party', '', party, votes])
+        yield flush()
+    t = turnout(conn, election[0])
+    writer.writerow(['turnout', 'votes cast', '', t['votes']])
+    writer.writerow(['turnout', 'verified voters', '', t['eligible']])
+    yield flush()
+
+
+def iter_json(conn, election, tabulation=None, candidates=()):
+    info = {'id': election[0], 'title': election[1], 'start_date': election[2], 'end_date': election[3]}
+    if tabulation is not None:
+        names = [c[1] for c in candidates]
+        yield json.dumps({
+            'election': dict(info, method=tabulation['method'], seats=tabulation['seats']),
+            'candidates': [{'name': name, 'party': party, 'rounds': counts, 'elected': elected}
+                           for name, party, counts, elected in round_rows(tabulation, candidates)],
+            'rounds': [{'exhausted': r['exhausted'], 'quota': r['quota'],
+                        'elected': [names[i] for i in r['elected']],
+                        'eliminated': [names[i] for i in r['eliminated']]} for r in tabulation['rounds']],
+            'elected': [names[i] for i in tabulation['elected']],
+            'ballots': tabulation['ballots'], 'quota': tabulation['quota'],
+            'turnout': turnout(conn, election[0])})
+        return
+    yield '{"election": %s, "candidates": [' % json.dumps(info)
+    sep = ''
+    for name, party, votes in candidate_rows(conn, election[0]):
+        yield sep + json.dumps({'name': name, 'party': party, 'votes': votes})
+        sep = ','
+    yield '], "parties": ['
+    sep = ''
+    for party, votes in party_rows(conn, election[0]):
+        yield sep + json.dumps({'party': party, 'votes': votes})
+        sep = ','
+    yield '], "turnout": %s}' % json.dumps(turnout(conn, election[0]))
+
+
+def build_xlsx(conn, election, tabulation=None, candidates=()):
+    buf = io.BytesIO()
+    t = turnout(conn, election[0])
+    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
+        if tabulation is not None:
+            rows = [[name, party] + counts + ['Yes' if elected else '']
+                    for name, party, counts, elected in round_rows(tabulation, candidates)]
+            if tabulation['method'] in ('irv', 'stv'):
+                rows.append(['Exhausted', ''] + [r['exhausted'] for r in tabulation['rounds']] + [''])
+            columns = ['Candidate', 'Party'] + [l.capitalize() for l in round_labels(tabulation)] + ['Elected']
+            pd.DataFrame(rows, columns=columns).to_excel(writer, sheet_name='Rounds', index=False)
+            pd.DataFrame([[tabulation['ballots'], tabulation['quota'], t['eligible'], t['rate']]],
+                         columns=['Ballots', 'Quota', 'Verified Voters', 'Turnout']).to_excel(writer, sheet_name='Turnout', index=False)
+        else:
+            pd.DataFrame(candidate_rows(conn, election[0]).fetchall(),
+                         columns=['Candidate', 'Party', 'Votes']).to_excel(writer, sheet_name='Candidates', index=False)
+            pd.DataFrame(party_rows(conn, election[0]).fetchall(),
+                         columns=['Party', 'Votes']).to_excel(writer, sheet_name='Parties', index=False)
+            pd.DataFrame([[t['votes'], t['eligible'], t['rate']]],
+                         columns=['Votes Cast', 'Verified Voters', 'Turnout']).to_excel(writer, sheet_name='Turnout', index=False)
+    return buf.getvalue()
+
+
+def artifact_path(folder, election_id, fmt):
+    return os.path.join(folder, f"election_{election_id}_results.{fmt}")
+
+
+def write_artifact(conn, election, fmt, folder, **kwargs):
+    """Render a closed election's export once and keep it on disk; ``kwargs``
+    are the tabulation and candidates of a ranked or approval election."""
+    os.makedirs(folder, exist_ok=True)
+    path = artifact_path(folder, election[0], fmt)
+    tmp = path + '.tmp'
+    if fmt == 'xlsx':
+        with open(tmp, 'wb') as f:
+            f.write(build_xlsx(conn, election, **kwargs))
+    else:
+        chunks = (iter_csv if fmt == 'csv' else iter_json)(conn, election, **kwargs)
+        with open(tmp, 'w', encoding='utf-8', newline='') as f:
+            f.writelines(chunks)
+    os.replace(tmp, path)
+    return path
+
+
+def purge_artifacts(folder, election_id):
+    for fmt in FORMATS:
+        try:
+            os.remove(artifact_path(folder, election_id, fmt))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,109 @@
+import io, time
+from concurrent.futures import ThreadPoolExecutor
+import db, storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it uploads are stored as-is
+    Image = None
+
+THUMB_SIZE = (240, 240)
+PHOTO_KINDS = ('citizenship', 'personal')
+
+
+def process_image(data):
+    """Validate an upload, strip its metadata and build a thumbnail.
+
+    Returns (clean_bytes, ext, thumb_bytes, (width, height)), or raises
+    ValueError if the bytes are not a readable image.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.verify()
+        with Image.open(io.BytesIO(data)) as img:
+            fmt = img.format
+            img = ImageOps.exif_transpose(img)
+            if fmt == 'JPEG' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            # Re-encoding without exif/pnginfo drops camera and GPS metadata
+            clean = io.BytesIO()
+            img.save(clean, format=fmt, **({'quality': 90, 'optimize': True} if fmt == 'JPEG' else {}))
+            size = img.size
+            img.thumbnail(THUMB_SIZE)
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            thumb = io.BytesIO()
+            img.save(thumb, format='JPEG', quality=80, optimize=True)
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError(f"not a valid image ({e})") from e
+    ext = {'JPEG': 'jpg', 'PNG': 'png'}.get(fmt, fmt.lower())
+    return clean.getvalue(), ext, thumb.getvalue(), size
+
+
+class ImagePipeline:
+    """Runs process_image off the request thread and records the results on the user row.
+
+    A raw upload replaced by its cleaned copy is only queued for deletion:
+    a registration with the same bytes gets the same key from put() before
+    its row exists, so blobs are deleted ``grace`` seconds later, if no row
+    references them by then.
+    """
+
+    def __init__(self, app, blobs, max_workers=2, grace=3600):
+        self.app = app
+        self.blobs = blobs
+        self.grace = grace
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='images')
+
+    def submit(self, user_id, photos):
+        """``photos`` maps each kind in PHOTO_KINDS to the storage key of the raw upload."""
+        return self.executor.submit(self.run, user_id, photos)
+
+    def run(self, user_id, photos):
+        updates, status, replaced = {}, 'ready', []
+        for kind, key in photos.items():
+            updates[f"{kind}_sha256"] = storage.key_hash(key)
+            if Image is None:
+                continue
+            try:
+                clean, ext, thumb, (width, height) = process_image(self.blobs.get(key))
+            except (ValueError, OSError) as e:
+                self.app.logger.warning("user %s %s photo rejected: %s", user_id, kind, e)
+                status = 'invalid'
+                continue
+            clean_key = self.blobs.put(clean, ext)
+            if clean_key != key:
+                replaced.append(key)
+            updates.update({
+                f"{kind}_photo": clean_key,
+                f"{kind}_thumb": self.blobs.put(thumb, 'jpg'),
+                f"{kind}_width": width,
+                f"{kind}_height": height,
+                f"{kind}_sha256": storage.key_hash(clean_key),
+            })
+        updates['photos_status'] = status
+        pool = db.get_pool(self.app)
+        conn = pool.acquire()
+        try:
+            with conn:
+                conn.execute(f"UPDATE users SET {', '.join(k + '=?' for k in updates)} WHERE id=?",
+                             list(updates.values()) + [user_id])
+                conn.executemany("INSERT OR REPLACE INTO blob_garbage(key, since) VALUES(?,?)",
+                                 [(key, time.time()) for key in replaced])
+            self.sweep(conn)
+        finally:
+            pool.release(conn)
+        return status
+
+    def sweep(self, conn):
+        """Delete the queued blobs past their grace period that no user row references."""
+        for (key,) in conn.execute("SELECT key FROM blob_garbage WHERE since < ?",
+                                   (time.time() - self.grace,)).fetchall():
+            if not conn.execute("SELECT 1 FROM users WHERE citizenship_photo=? OR personal_photo=?",
+                                (key, key)).fetchone():
+                self.blobs.delete(key)
+            with conn:
+                conn.execute("DELETE FROM blob_garbage WHERE key=?", (key,))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
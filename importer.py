@@ -0,0 +1,171 @@
+import json, logging, os, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import pandas as pd
+import db
+
+log = logging.getLogger('voting.importer')
+
+ROLL_COLUMNS = ('username', 'password', 'name', 'dob', 'citizenship_id')
+
+
+def iter_roll(stream, filename, chunksize=1000):
+    """Yield the voter roll as lists of (line_no, row_dict), ``chunksize`` rows at a time."""
+    if filename.lower().endswith('.xlsx'):
+        yield from _iter_xlsx(stream, chunksize)
+        return
+    line_no = 2  # header is line 1
+    for frame in pd.read_csv(stream, chunksize=chunksize, dtype=str, keep_default_na=False,
+                             skipinitialspace=True):
+        frame.columns = [str(c).strip().lower() for c in frame.columns]
+        rows = frame.to_dict('records')
+        yield [(line_no + i, row) for i, row in enumerate(rows)]
+        line_no += len(rows)
+
+
+def _iter_xlsx(stream, chunksize):
+    from openpyxl import load_workbook
+    sheet = load_workbook(stream, read_only=True, data_only=True).active
+    rows = sheet.iter_rows(values_only=True)
+    header = [str(c or '').strip().lower() for c in next(rows, ())]
+    chunk = []
+    for line_no, values in enumerate(rows, start=2):
+        chunk.append((line_no, {k: '' if v is None else str(v) for k, v in zip(header, values)}))
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def validate_row(row):
+    missing = [c for c in ROLL_COLUMNS if not str(row.get(c, '')).strip()]
+    if missing:
+        return None, "missing " + ", ".join(missing)
+    dob = str(row['dob']).strip()[:10]
+    try:
+        date.fromisoformat(dob)
+    except ValueError:
+        return None, f"invalid dob {row['dob']!r} (expected YYYY-MM-DD)"
+    return (str(row['username']).strip(), str(row['password']), str(row['name']).strip(),
+            dob, str(row['citizenship_id']).strip()), None
+
+
+def import_voters(conn, stream, filename, verified=False, chunksize=1000, hash_passwords=None, progress=None):
+    """Stream a CSV/XLSX voter roll into users, one transaction per chunk.
+
+    ``hash_passwords`` maps a list of plaintext passwords to their hashes;
+    without it passwords are stored as given. ``progress(inserted, errors)``
+    is called after each chunk.
+
+    Returns (inserted, errors) where errors is a list of (line_no, message).
+    """
+    inserted, errors = 0, []
+    for chunk in iter_roll(stream, filename, chunksize):
+        valid, seen = [], set()
+        for line_no, row in chunk:
+            values, error = validate_row(row)
+            if error is None and values[0] in seen:
+                error = f"duplicate username {values[0]!r} in file"
+            if error:
+                errors.append((line_no, error))
+                continue
+            seen.add(values[0])
+            valid.append((line_no, values))
+        if not valid:
+            continue
+        usernames = [v[0] for _, v in valid]
+        existing = {r[0] for r in conn.execute(
+            f"SELECT username FROM users WHERE username IN ({','.join('?' * len(usernames))})",
+            usernames)}
+        lines, batch = [], []
+        for line_no, values in valid:
+            if values[0] in existing:
+                errors.append((line_no, f"username {values[0]!r} already exists"))
+            else:
+                lines.append(line_no)
+                batch.append(values + (1 if verified else 0,))
+        if hash_passwords is not None and batch:
+            hashes = hash_passwords([v[1] for v in batch])
+            batch = [(v[0], h) + v[2:] for v, h in zip(batch, hashes)]
+        # Row by row rather than executemany(): only each row's rowcount tells
+        # which usernames a concurrent registration took since the SELECT
+        with conn:
+            for line_no, values in zip(lines, batch):
+                # A concurrent import or registration may have taken the name since the SELECT
+                if conn.execute("""
+                    INSERT OR IGNORE INTO users(username,password,name,dob,citizenship_id,verified)
+                    VALUES(?,?,?,?,?,?)""", values).rowcount:
+                    inserted += 1
+                else:
+                    errors.append((line_no, f"username {values[0]!r} already exists"))
+        if progress is not None:
+            progress(inserted, errors)
+    return inserted, errors
+
+
+class ImportJobs:
+    """Runs uploaded voter rolls through import_voters() on a background
+    thread, one at a time per process, so hashing thousands of passwords
+    never holds an HTTP request open. The upload is saved to ``folder``
+    first; progress and rejected rows are kept in the import_jobs table.
+    """
+
+    def __init__(self, app, folder, hash_passwords=None, chunksize=1000):
+        self.app = app
+        self.folder = folder
+        self.hash_passwords = hash_passwords
+        self.chunksize = chunksize
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='import')
+
+    def submit(self, conn, stream, filename, verified=False):
+        """Queue an import of ``stream``; returns the job id."""
+        with conn:
+            job_id = conn.execute("INSERT INTO import_jobs(filename, created) VALUES(?,?)",
+                                  (filename, time.time())).lastrowid
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, f"import_{job_id}{os.path.splitext(filename)[1].lower()}")
+        with open(path, 'wb') as f:
+            while chunk := stream.read(1 << 20):
+                f.write(chunk)
+        self.executor.submit(self.run, job_id, path, verified)
+        return job_id
+
+    def run(self, job_id, path, verified):
+        pool = db.get_pool(self.app)
+        conn = pool.acquire()
+
+        def update(status, inserted, errors, **extra):
+            with conn:
+                conn.execute(f"""UPDATE import_jobs SET status=?, inserted=?, rejected=?, errors=?
+                                 {''.join(f', {k}=?' for k in extra)} WHERE id=?""",
+                             (status, inserted, len(errors), json.dumps(errors), *extra.values(), job_id))
+        try:
+            update('running', 0, [])
+            with open(path, 'rb') as f:
+                inserted, errors = import_voters(conn, f, path, verified=verified, chunksize=self.chunksize,
+                                                 hash_passwords=self.hash_passwords,
+                                                 progress=lambda n, e: update('running', n, e))
+            update('done', inserted, errors, finished=time.time())
+        except Exception as e:
+            log.exception("voter import %s failed", job_id)
+            row = conn.execute("SELECT inserted, errors FROM import_jobs WHERE id=?", (job_id,)).fetchone()
+            update('failed', row[0], json.loads(row[1] or '[]'), message=str(e), finished=time.time())
+        finally:
+            pool.release(conn)
+            os.remove(path)
+
+    def get(self, conn, job_id):
+        """The job as a dict, or None."""
+        row = conn.execute("""SELECT id, filename, status, inserted, rejected, errors, message, created, finished
+                              FROM import_jobs WHERE id=?""", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(('id', 'filename', 'status', 'inserted', 'rejected', 'errors', 'message',
+                        'created', 'finished'), row))
+        job['errors'] = json.loads(job['errors'] or '[]')
+        return job
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
@@ -0,0 +1,131 @@
+import logging, queue, sqlite3, threading, time
+from concurrent.futures import Future
+import db
+
+log = logging.getLogger('voting.ingest')
+
+
+class Unconfirmed(Exception):
+    """The writer did not confirm a ballot in time; it may still be committed."""
+
+
+class VoteWriter:
+    """Group-commits ballots from many request threads on one writer connection.
+
+    Each submit() returns a Future that resolves to True (recorded), False
+    (the user had already voted) or an exception, and only after the batch
+    holding it has been committed with synchronous=FULL, so a True result
+    means the ballot is on disk. A batch closes when it reaches
+    ``batch_size`` ballots or ``max_delay`` seconds after its first ballot.
+    Ballots for sharded elections (see shards.py) are committed on their
+    shard, one transaction per shard in the batch.
+    """
+
+    def __init__(self, app, batch_size=256, max_delay=0.005, on_commit=None, shards=None):
+        self.app = app
+        self.shards = shards
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.on_commit = on_commit
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.ballots = 0
+
+    def submit(self, user_id, election_id, candidate_id, sharded=False, ranks=None):
+        future = Future()
+        self.queue.put((user_id, election_id, candidate_id, future, sharded, ranks))
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, daemon=True, name='vote-writer')
+                    self.thread.start()
+        return future
+
+    def take_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def connection(self, conns, shard):
+        """(pool, conn) to commit a group on; shard connections are borrowed from
+        their pool per group, so evicting or dropping the pool waits for them."""
+        if shard is not None:
+            pool = self.shards.pool(shard)
+            conn = pool.acquire()
+            conn.execute("PRAGMA synchronous=FULL")
+            return pool, conn
+        conn = conns.get(shard)
+        if conn is None:
+            conn = conns[shard] = db.get_pool(self.app).connect()
+            conn.execute("PRAGMA synchronous=FULL")
+        return None, conn
+
+    def run(self):
+        conns = {}
+        while True:
+            batch = self.take_batch()
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[1] if item[4] else None, []).append(item)
+            for shard, items in groups.items():
+                # A failure fails this group's ballots only; the writer keeps running
+                try:
+                    pool, conn = self.connection(conns, shard)
+                except Exception as e:
+                    log.exception("vote writer could not open %s", f"shard {shard}" if shard else "the database")
+                    for item in items:
+                        item[3].set_exception(e)
+                    continue
+                ok = self.commit(conn, items, shard is not None)
+                if pool is not None:
+                    try:
+                        conn.execute(f"PRAGMA synchronous={pool.synchronous}")
+                    except sqlite3.Error:
+                        pass  # released all the same; a broken connection fails its next user
+                    pool.release(conn)
+                elif not ok:
+                    # Start the next batch on a fresh connection in case this one is broken
+                    conns.pop(shard, None)
+                    conn.close()
+
+    def commit(self, conn, batch, sharded):
+        """Record and commit one group of ballots; returns False if the transaction failed."""
+        results = []
+        try:
+            # A shard connection has the main database attached; IMMEDIATE would lock it too
+            conn.execute("BEGIN" if sharded else "BEGIN IMMEDIATE")
+            for user_id, election_id, candidate_id, _, _, ranks in batch:
+                try:
+                    db.record_vote(conn, user_id, election_id, candidate_id, ranks)
+                    results.append(True)
+                except sqlite3.IntegrityError:
+                    # Only the failed statement is undone; the rest of the batch stands
+                    results.append(False)
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for item in batch:
+                item[3].set_exception(e)
+            return False
+        self.batches += 1
+        self.ballots += len(batch)
+        for item, ok in zip(batch, results):
+            item[3].set_result(ok)
+        if self.on_commit is not None:
+            for election_id in {item[1] for item, ok in zip(batch, results) if ok}:
+                try:
+                    self.on_commit(election_id)
+                except Exception:
+                    log.exception("vote writer on_commit failed for election %s", election_id)
+        return True
@@ -0,0 +1,325 @@
+import hashlib, json, sys, time
+
+# An append-only Merkle log of every ballot event, one tree per election,
+# hashed as in RFC 6962: a leaf is SHA-256(0x00 || record) and an interior
+# node SHA-256(0x01 || left || right). Each complete ("perfect") subtree's
+# hash is stored in ledger_nodes as soon as its last leaf arrives, so any
+# subtree hash, root or inclusion proof takes O(log n) lookups.
+#
+# Every checkpoint_interval leaves the root and the frontier (the perfect
+# subtrees that make up the tree at that size) go into ledger_checkpoints;
+# an audit resumes from the latest checkpoint and only rehashes what came
+# after it. A 'vote' record is written with each ballot and a 'void' record
+# when a ballot is withdrawn (its candidate was deleted). A ranked or
+# approval ballot whose first mark was deleted gets an 'amend' record with
+# its next remaining mark as candidate_id; the latest of a ballot's 'vote'
+# and 'amend' records is the one its votes row must match. Triggers reject
+# updates and deletes; see db.MIGRATIONS and shards.SCHEMA.
+TABLES = ('ledger', 'ledger_nodes', 'ledger_checkpoints')
+EMPTY_ROOT = hashlib.sha256(b'').digest()
+checkpoint_interval = 1024
+
+
+def record(election_id, seq, kind, vote_id, user_id, candidate_id, ranks=None):
+    """The canonical bytes a leaf hashes."""
+    return (f"{kind}|{election_id}|{seq}|{vote_id}|{user_id}|{candidate_id}|"
+            f"{ranks.hex() if ranks else ''}").encode()
+
+
+def leaf_hash(data):
+    return hashlib.sha256(b'\0' + data).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(b'\1' + left + right).digest()
+
+
+def _fold(frontier):
+    """The root of a tree given its perfect subtrees, largest (leftmost) first."""
+    if not frontier:
+        return EMPTY_ROOT
+    root = frontier[-1]
+    for h in reversed(frontier[:-1]):
+        root = node_hash(h, root)
+    return root
+
+
+def _frontier_positions(size):
+    """(level, index) of the perfect subtrees covering ``size`` leaves, left to right."""
+    positions, start = [], 0
+    for level in range(size.bit_length() - 1, -1, -1):
+        if size >> level & 1:
+            positions.append((level, start >> level))
+            start += 1 << level
+    return positions
+
+
+def _node(conn, election_id, level, idx):
+    if level == 0:
+        row = conn.execute("SELECT leaf FROM ledger WHERE election_id=? AND seq=?", (election_id, idx)).fetchone()
+    else:
+        row = conn.execute("SELECT hash FROM ledger_nodes WHERE election_id=? AND level=? AND idx=?",
+                           (election_id, level, idx)).fetchone()
+    if row is None:
+        raise LookupError(f"election {election_id}: ledger node {level}/{idx} is missing")
+    return row[0]
+
+
+def _subtree(conn, election_id, lo, hi):
+    """MTH(D[lo:hi]); ``lo`` is always aligned to the largest power of two below hi - lo."""
+    n = hi - lo
+    if n & (n - 1) == 0:
+        level = n.bit_length() - 1
+        return _node(conn, election_id, level, lo >> level)
+    k = 1 << ((n - 1).bit_length() - 1)
+    return node_hash(_subtree(conn, election_id, lo, lo + k), _subtree(conn, election_id, lo + k, hi))
+
+
+def _completed(conn, election_id, lo, hi):
+    """Stored subtree hashes whose last leaf is in ``lo..hi-1``, by (level, index)."""
+    nodes = {}
+    for level in range(1, hi.bit_length()):
+        first, last = lo >> level, (hi >> level) - 1
+        if first <= last:
+            for idx, h in conn.execute("""SELECT idx, hash FROM ledger_nodes
+                                          WHERE election_id=? AND level=? AND idx BETWEEN ? AND ?""",
+                                       (election_id, level, first, last)):
+                nodes[level, idx] = h
+    return nodes
+
+
+def size(conn, election_id):
+    return conn.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM ledger WHERE election_id=?",
+                        (election_id,)).fetchone()[0]
+
+
+def root(conn, election_id, at=None):
+    at = size(conn, election_id) if at is None else at
+    return _fold([_node(conn, election_id, level, idx) for level, idx in _frontier_positions(at)])
+
+
+def append(conn, election_id, kind, vote_id, user_id, candidate_id, ranks=None):
+    """Add a record and the subtree hashes it completes; the caller owns the transaction."""
+    seq = size(conn, election_id)
+    h = leaf_hash(record(election_id, seq, kind, vote_id, user_id, candidate_id, ranks))
+    conn.execute("""INSERT INTO ledger(election_id, seq, kind, vote_id, user_id, candidate_id, ranks, leaf)
+                    VALUES(?,?,?,?,?,?,?,?)""", (election_id, seq, kind, vote_id, user_id, candidate_id, ranks, h))
+    level, idx = 0, seq
+    while idx & 1:
+        h = node_hash(_node(conn, election_id, level, idx - 1), h)
+        level, idx = level + 1, idx >> 1
+        conn.execute("INSERT INTO ledger_nodes(election_id, level, idx, hash) VALUES(?,?,?,?)",
+                     (election_id, level, idx, h))
+    if checkpoint_interval and (seq + 1) % checkpoint_interval == 0:
+        checkpoint(conn, election_id, seq + 1)
+    return seq
+
+
+def checkpoint(conn, election_id, at=None):
+    """Record the root at ``at`` leaves (default: all of them); returns it."""
+    at = size(conn, election_id) if at is None else at
+    frontier = [_node(conn, election_id, level, idx) for level, idx in _frontier_positions(at)]
+    root = _fold(frontier)
+    conn.execute("""INSERT OR IGNORE INTO ledger_checkpoints(election_id, size, root, frontier, created)
+                    VALUES(?,?,?,?,?)""", (election_id, at, root, b''.join(frontier), time.time()))
+    return root
+
+
+def checkpoints(conn, election_id):
+    return conn.execute("SELECT size, root, created FROM ledger_checkpoints WHERE election_id=? ORDER BY size",
+                        (election_id,)).fetchall()
+
+
+def live_ballots(conn, election_id):
+    """(vote_id, user_id, candidate_id, ranks) of every ballot recorded and not voided, by
+    vote_id, as its latest 'vote' or 'amend' record has it."""
+    return conn.execute("""
+        SELECT vote_id, user_id, candidate_id, ranks FROM ledger l
+        WHERE election_id=? AND kind IN ('vote', 'amend') AND NOT EXISTS (
+          SELECT 1 FROM ledger x WHERE x.election_id=l.election_id AND x.vote_id=l.vote_id
+          AND (x.kind='void' OR x.kind='amend' AND x.seq > l.seq))
+        ORDER BY vote_id
+    """, (election_id,))
+
+
+def backfill(conn, election_id):
+    """Start the ledger of an election whose ballots predate it; returns how many were added."""
+    if size(conn, election_id):
+        return 0
+    rows = conn.execute("SELECT id, user_id, candidate_id, ranks FROM votes WHERE election_id=? ORDER BY id",
+                        (election_id,)).fetchall()
+    with conn:
+        for row in rows:
+            append(conn, election_id, 'vote', *row)
+    return len(rows)
+
+
+def copy_to(conn, election_id, schema):
+    """Copy an election's ledger from ``conn``'s main database into the attached ``schema``."""
+    for table in TABLES:
+        conn.execute(f"INSERT OR IGNORE INTO {schema}.{table} SELECT * FROM main.{table} WHERE election_id=?",
+                     (election_id,))
+
+
+def proof(conn, election_id, vote_id, at=None):
+    """An inclusion proof for a ballot's 'vote' record against the root at ``at`` leaves.
+
+    The result is JSON-ready and checked by verify_proof(); None if the
+    ballot was never recorded (or is not covered by a tree of that size).
+    """
+    at = size(conn, election_id) if at is None else at
+    row = conn.execute("""SELECT seq, kind, vote_id, user_id, candidate_id, ranks, leaf FROM ledger
+                          WHERE election_id=? AND vote_id=? AND kind='vote'""", (election_id, vote_id)).fetchone()
+    if row is None or row[0] >= at:
+        return None
+    seq = row[0]
+    path, lo, hi = [], 0, at
+    while hi - lo > 1:
+        k = 1 << ((hi - lo - 1).bit_length() - 1)
+        if seq < lo + k:
+            path.append(_subtree(conn, election_id, lo + k, hi))
+            hi = lo + k
+        else:
+            path.append(_subtree(conn, election_id, lo, lo + k))
+            lo += k
+    path.reverse()  # leaf to root
+    return {'election_id': election_id, 'vote_id': vote_id, 'leaf_index': seq, 'tree_size': at,
+            'record': record(election_id, *row[:6]).decode(), 'leaf': row[6].hex(),
+            'path': [h.hex() for h in path], 'root': root(conn, election_id, at).hex()}
+
+
+def verify_inclusion(leaf, index, tree_size, path, expected_root):
+    """RFC 9162 section 2.1.3.2: does ``path`` lead from leaf ``index`` to ``expected_root``?"""
+    if index >= tree_size:
+        return False
+    fn, sn, h = index, tree_size - 1, leaf
+    for p in path:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            h = node_hash(p, h)
+            if not fn & 1:
+                while fn and not fn & 1:
+                    fn, sn = fn >> 1, sn >> 1
+        else:
+            h = node_hash(h, p)
+        fn, sn = fn >> 1, sn >> 1
+    return sn == 0 and h == expected_root
+
+
+def verify_proof(proof, expected_root=None):
+    """Check a proof() result; ``expected_root`` (hex) is a root published elsewhere."""
+    leaf = leaf_hash(proof['record'].encode())
+    if leaf.hex() != proof['leaf']:
+        return False
+    root = bytes.fromhex(expected_root or proof['root'])
+    return verify_inclusion(leaf, proof['leaf_index'], proof['tree_size'],
+                            [bytes.fromhex(h) for h in proof['path']], root)
+
+
+def audit(conn, election_id, full=False, ballots=True, max_errors=100):
+    """Verify an election's ledger, from its latest checkpoint unless ``full``.
+
+    Recomputes each leaf from its record and every subtree hash and
+    checkpoint root above the starting point. With ``ballots`` the votes
+    table must also hold exactly the ballots the ledger records and has not
+    voided (the tallies are db.check_tallies()' business). Returns a report dict whose
+    ``errors`` list is empty when everything holds.
+    """
+    errors = []
+
+    def error(message):
+        if len(errors) < max_errors:
+            errors.append(message)
+
+    head = size(conn, election_id)
+    start = None if full else conn.execute("""
+        SELECT size, root, frontier FROM ledger_checkpoints WHERE election_id=? AND size<=?
+        ORDER BY size DESC LIMIT 1""", (election_id, head)).fetchone()
+    stack = []  # (level, hash) of the perfect subtrees so far, largest first
+    if start:
+        frontier = [start[2][i:i + 32] for i in range(0, len(start[2]), 32)]
+        stack = [(level, h) for (level, _), h in zip(_frontier_positions(start[0]), frontier)]
+        if _fold(frontier) != start[1]:
+            error(f"checkpoint at {start[0]}: frontier does not hash to its root")
+        for (level, idx), h in zip(_frontier_positions(start[0]), frontier):
+            try:
+                if _node(conn, election_id, level, idx) != h:
+                    error(f"node {level}/{idx} differs from checkpoint {start[0]}")
+            except LookupError as e:
+                error(str(e))
+    first = start[0] if start else 0
+    roots = {n: r for n, r, _ in checkpoints(conn, election_id) if n > first}
+    computed = {}  # subtree hashes rebuilt since ``chunk``, checked against the stored ones in batches
+
+    def compare(lo, hi):
+        stored = _completed(conn, election_id, lo, hi)
+        for key in sorted(computed.keys() | stored.keys()):
+            if computed.get(key) != stored.get(key):
+                error(f"node {key[0]}/{key[1]} does not match the records below it")
+        computed.clear()
+
+    expected = chunk = first
+    for seq, kind, vote_id, user_id, candidate_id, ranks, leaf in conn.execute("""
+            SELECT seq, kind, vote_id, user_id, candidate_id, ranks, leaf FROM ledger
+            WHERE election_id=? AND seq>=? ORDER BY seq""", (election_id, first)):
+        if seq != expected:
+            error(f"records {expected}..{seq - 1} are missing")
+        expected = seq + 1
+        h = leaf_hash(record(election_id, seq, kind, vote_id, user_id, candidate_id, ranks))
+        if h != leaf:
+            error(f"record {seq} (vote {vote_id}) does not match its leaf hash")
+        level, idx = 0, seq
+        while stack and stack[-1][0] == level:
+            h = node_hash(stack.pop()[1], h)
+            level, idx = level + 1, idx >> 1
+            computed[level, idx] = h
+        stack.append((level, h))
+        if seq + 1 in roots and _fold([s[1] for s in stack]) != roots[seq + 1]:
+            error(f"checkpoint at {seq + 1} does not match the records")
+        if expected - chunk >= 4096:
+            compare(chunk, expected)
+            chunk = expected
+    compare(chunk, expected)
+    root = _fold([s[1] for s in stack])
+
+    if ballots:
+        for (vote_id,) in conn.execute("""
+                SELECT v.id FROM votes v
+                LEFT JOIN ledger l ON l.election_id=v.election_id AND l.vote_id=v.id
+                     AND l.kind IN ('vote', 'amend') AND NOT EXISTS (
+                       SELECT 1 FROM ledger y WHERE y.election_id=v.election_id AND y.vote_id=v.id
+                       AND y.kind='amend' AND y.seq > l.seq)
+                WHERE v.election_id=? AND (l.seq IS NULL OR l.user_id IS NOT v.user_id
+                      OR l.candidate_id IS NOT v.candidate_id OR l.ranks IS NOT v.ranks
+                      OR EXISTS (SELECT 1 FROM ledger x WHERE x.election_id=v.election_id
+                                 AND x.vote_id=v.id AND x.kind='void'))
+                """, (election_id,)):
+            error(f"ballot {vote_id} is not in the ledger as recorded")
+        for (vote_id,) in conn.execute("""
+                SELECT l.vote_id FROM ledger l
+                LEFT JOIN votes v ON v.id=l.vote_id AND v.election_id=l.election_id
+                WHERE l.election_id=? AND l.kind='vote' AND v.id IS NULL AND NOT EXISTS (
+                  SELECT 1 FROM ledger x WHERE x.election_id=l.election_id AND x.vote_id=l.vote_id
+                  AND x.kind='void')""", (election_id,)):
+            error(f"ballot {vote_id} was removed without a void record")
+    return {'election_id': election_id, 'size': head, 'root': root.hex(), 'verified_from': first,
+            'rehashed': head - first, 'checkpoints': len(roots) + bool(start), 'errors': errors}
+
+
+def main(argv=None):
+    """python ledger.py PROOF.json [ROOT]: check a saved inclusion proof offline."""
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        print(main.__doc__)
+        return 2
+    with open(argv[0]) as f:
+        p = json.load(f)
+    ok = verify_proof(p, argv[1] if len(argv) > 1 else None)
+    print(f"vote {p['vote_id']} of election {p['election_id']} is {'' if ok else 'NOT '}included "
+          f"in the {p['tree_size']}-record tree with root {argv[1] if len(argv) > 1 else p['root']}")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import logging, threading, time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import db
+
+log = logging.getLogger('voting.lifecycle')
+
+
+def instants(start_date, end_date, timezone=None):
+    """(opens_at, closes_at) in epoch seconds for an election's form values.
+
+    Values are ISO dates or datetimes read in ``timezone`` (an IANA name;
+    server-local time if None) unless they carry their own offset. A bare
+    end date closes at the end of that day. Raises ValueError for bad input.
+    """
+    try:
+        zone = ZoneInfo(timezone) if timezone else None
+    except (ValueError, ZoneInfoNotFoundError):
+        raise ValueError(f"Unknown timezone {timezone!r}.") from None
+
+    def instant(value, end):
+        try:
+            dt = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Invalid date {value!r}.") from None
+        if end and len(value) == 10:
+            dt += timedelta(days=1)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=zone) if zone else dt.astimezone()
+        return int(dt.timestamp())
+    opens_at, closes_at = instant(start_date, False), instant(end_date, True)
+    if closes_at <= opens_at:
+        raise ValueError("The election must end after it starts.")
+    return opens_at, closes_at
+
+
+def state(opens_at, closes_at, now=None):
+    """'draft' before ``opens_at``, 'open' until ``closes_at``, then 'closed'."""
+    if opens_at is None or closes_at is None:
+        return 'draft'
+    now = time.time() if now is None else now
+    return 'draft' if now < opens_at else 'open' if now < closes_at else 'closed'
+
+
+class Lifecycle:
+    """Fires each election's transitions from a per-process thread that sleeps
+    until the next opening or closing instant.
+
+    Whether an election accepts ballots is decided from its instants alone
+    (see state()), so this thread only runs hooks and never gates a vote.
+    ``on_open(ids)`` and ``on_close(ids)`` run in every process, for its own
+    caches. ``on_finalize(id)`` runs ``grace`` seconds after the close, so
+    ballots already accepted have been committed, in the process whose
+    UPDATE claims the election ('closing' for ``lease`` seconds). Only once
+    it returns is the election 'closed'; if it raises, the claim is
+    released for the next tick to retry, and if the process dies the claim
+    lapses.
+    """
+
+    def __init__(self, app, on_open=None, on_close=None, on_finalize=None, grace=60, poll=60, lease=600):
+        self.app = app
+        self.on_open = on_open
+        self.on_close = on_close
+        self.on_finalize = on_finalize
+        self.grace = grace
+        self.poll = poll
+        self.lease = lease
+        self.last = time.time()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, daemon=True, name='election-lifecycle')
+                    self.thread.start()
+
+    def wake(self):
+        """Recompute the next instant now (an election was created or re-dated)."""
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            try:
+                upcoming = self.tick()
+            except Exception:
+                log.exception("election lifecycle tick failed")
+                upcoming = None
+            timeout = self.poll if upcoming is None else min(max(upcoming - time.time(), 0), self.poll)
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    def tick(self, now=None):
+        """Fire every transition due by ``now``; returns the next instant to wake at, if any."""
+        now = time.time() if now is None else now
+        with self.app.app_context():
+            conn = db.get_db()
+            last, self.last = self.last, now
+            opened = [r[0] for r in conn.execute(
+                "SELECT id FROM elections WHERE start_ts > ? AND start_ts <= ?", (last, now))]
+            closed = [r[0] for r in conn.execute(
+                "SELECT id FROM elections WHERE end_ts > ? AND end_ts <= ?", (last, now))]
+            if opened and self.on_open:
+                self.on_open(opened)
+            if closed and self.on_close:
+                self.on_close(closed)
+            with conn:
+                conn.execute("UPDATE elections SET state='open' WHERE state='draft' AND start_ts <= ? AND end_ts > ?",
+                             (now, now))
+            for (election_id,) in conn.execute("""
+                    SELECT id FROM elections WHERE state!='closed' AND end_ts <= ?
+                    AND (state!='closing' OR claimed_until <= ?)""", (now - self.grace, now)).fetchall():
+                with conn:
+                    claimed = conn.execute("""
+                        UPDATE elections SET state='closing', claimed_until=? WHERE id=? AND state!='closed'
+                        AND (state!='closing' OR claimed_until <= ?)""", (now + self.lease, election_id, now)).rowcount
+                if not claimed:
+                    continue
+                try:
+                    if self.on_finalize:
+                        self.on_finalize(election_id)
+                except Exception:
+                    log.exception("finalizing election %s failed; retrying", election_id)
+                    with conn:
+                        conn.execute("UPDATE elections SET claimed_until=? WHERE id=?", (now, election_id))
+                    continue
+                with conn:
+                    conn.execute("UPDATE elections SET state='closed', claimed_until=NULL WHERE id=?",
+                                 (election_id,))
+            return conn.execute("""
+                SELECT MIN(t) FROM (
+                  SELECT MIN(start_ts) AS t FROM elections WHERE start_ts > :now
+                  UNION ALL SELECT MIN(end_ts) FROM elections WHERE end_ts > :now
+                  UNION ALL SELECT MIN(end_ts) + :grace FROM elections WHERE state!='closed' AND end_ts + :grace > :now
+                  UNION ALL SELECT MIN(claimed_until) FROM elections WHERE state='closing' AND claimed_until > :now)
+            """, {'now': now, 'grace': self.grace}).fetchone()[0]
@@ -0,0 +1,135 @@
+import json, logging, threading, queue, time
+import db
+
+log = logging.getLogger('voting.live')
+
+
+class TallyFeed:
+    """One background producer per election that fans tally changes out to
+    every connected results stream.
+
+    Votes only poke the feed; the producer coalesces pokes over ``interval``
+    seconds and reads the tallies table once per tick, no matter how many
+    admins are watching. Without pokes (e.g. votes landing in another worker
+    process) it still re-reads every ``idle_poll`` seconds.
+    """
+
+    def __init__(self, app, election_id, interval, idle_poll, pool_for=None):
+        self.app = app
+        self.election_id = election_id
+        self.pool_for = pool_for
+        self.interval = interval
+        self.idle_poll = idle_poll
+        self.subscribers = set()
+        self.snapshot = None
+        self.dirty = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def read(self):
+        pool = self.pool_for(self.election_id) if self.pool_for else db.get_pool(self.app)
+        conn = pool.acquire()
+        try:
+            rows = conn.execute(
+                "SELECT candidates.name, SUM(tallies.count) FROM tallies "
+                "JOIN candidates ON tallies.candidate_id = candidates.id "
+                "WHERE tallies.election_id = ? AND tallies.count > 0 "
+                "GROUP BY candidates.name", (self.election_id,)
+            ).fetchall()
+        finally:
+            pool.release(conn)
+        return dict(rows)
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=100)
+        with self.lock:
+            if self.snapshot is None:
+                self.snapshot = self.read()
+            q.put(('snapshot', dict(self.snapshot)))
+            self.subscribers.add(q)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name=f"tally-feed-{self.election_id}")
+                self.thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def run(self):
+        while True:
+            self.dirty.wait(self.idle_poll)
+            time.sleep(self.interval)
+            self.dirty.clear()
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    self.snapshot = None
+                    return
+            try:
+                current = self.read()
+            except Exception:
+                # Subscribers keep the last snapshot; back off and read again
+                log.exception("election %s: reading tallies for the live feed failed", self.election_id)
+                time.sleep(self.idle_poll)
+                continue
+            delta = {name: count for name, count in current.items()
+                     if self.snapshot.get(name) != count}
+            delta.update((name, 0) for name in self.snapshot.keys() - current.keys())
+            with self.lock:
+                self.snapshot = current
+                if delta:
+                    for q in list(self.subscribers):
+                        try:
+                            q.put_nowait(('delta', delta))
+                        except queue.Full:
+                            # A stalled client skips the backlog and resyncs from a snapshot.
+                            with q.mutex:
+                                q.queue.clear()
+                            q.put_nowait(('snapshot', dict(current)))
+
+
+class TallyFeeds:
+    """``pool_for(election_id)``, if given, picks the pool holding an
+    election's tallies (see shards.py); the default is the main pool."""
+
+    def __init__(self, app, interval=1.0, idle_poll=5.0, pool_for=None):
+        self.app = app
+        self.pool_for = pool_for
+        self.interval = interval
+        self.idle_poll = idle_poll
+        self.feeds = {}
+        self.lock = threading.Lock()
+
+    def get(self, election_id):
+        with self.lock:
+            feed = self.feeds.get(election_id)
+            if feed is None:
+                feed = self.feeds[election_id] = TallyFeed(self.app, election_id, self.interval,
+                                                           self.idle_poll, self.pool_for)
+            return feed
+
+    def notify(self, election_id):
+        feed = self.feeds.get(election_id)
+        if feed is not None:
+            feed.dirty.set()
+
+    def discard(self, election_id):
+        with self.lock:
+            self.feeds.pop(election_id, None)
+
+    def stream(self, election_id, keepalive=15):
+        feed = self.get(election_id)
+        q = feed.subscribe()
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event, data = q.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            feed.unsubscribe(q)
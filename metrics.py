@@ -0,0 +1,143 @@
+import logging, threading, time
+from flask import g, has_request_context, request
+import db
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+log = logging.getLogger('voting.metrics')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.values.items())
+        names = self.labels + ('le',)
+        for labels, (counts, total, sum_) in items:
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{_labels(names, labels + (bound,))} {count}"
+            yield f"{self.name}_bucket{_labels(names, labels + ('+Inf',))} {total}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {sum_}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {total}"
+
+
+class Gauge:
+    """A value read from ``fn`` at scrape time; ``fn`` returns {label_tuple: value}."""
+
+    def __init__(self, name, help, fn, labels=()):
+        self.name, self.help, self.fn, self.labels = name, help, fn, tuple(labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in sorted(self.fn().items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Metrics:
+    """Per-process request and SQL instrumentation, rendered in Prometheus text format."""
+
+    def __init__(self, app=None):
+        self.collectors = []
+        self.request_duration = self.add(Histogram(
+            'voting_request_duration_seconds', 'Request latency by route.', ('endpoint', 'method')))
+        self.requests = self.add(Counter(
+            'voting_requests_total', 'Requests by route and status.', ('endpoint', 'method', 'status')))
+        self.request_queries = self.add(Histogram(
+            'voting_request_db_queries', 'SQL statements executed per request.', ('endpoint',), COUNT_BUCKETS))
+        self.query_duration = self.add(Histogram(
+            'voting_db_query_duration_seconds', 'SQL statement execution time by statement kind.', ('kind',)))
+        self.slow_queries = self.add(Counter(
+            'voting_db_slow_queries_total', 'SQL statements slower than DB_SLOW_QUERY_MS.', ('kind',)))
+        if app is not None:
+            self.init_app(app)
+
+    def add(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def init_app(self, app):
+        app.config.setdefault('DB_SLOW_QUERY_MS', 100)
+        self.slow_threshold = app.config['DB_SLOW_QUERY_MS'] / 1000
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        db.query_hooks.append(self.on_query)
+
+    def before_request(self):
+        g.request_started = time.perf_counter()
+        g.query_count = 0
+        g.query_time = 0.0
+
+    def after_request(self, response):
+        started = g.pop('request_started', None)
+        if started is None:
+            return response
+        took = time.perf_counter() - started
+        endpoint = request.url_rule.rule if request.url_rule else '<unmatched>'
+        self.request_duration.observe(took, endpoint, request.method)
+        self.requests.inc(endpoint, request.method, response.status_code)
+        self.request_queries.observe(g.query_count, endpoint)
+        response.headers['Server-Timing'] = (f'db;dur={g.query_time * 1000:.2f};desc="{g.query_count} queries", '
+                                             f'app;dur={took * 1000:.2f}')
+        return response
+
+    def on_query(self, sql, took):
+        kind = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+        self.query_duration.observe(took, kind)
+        if took >= self.slow_threshold:
+            self.slow_queries.inc(kind)
+            log.warning("slow query (%.1f ms): %s", took * 1000, ' '.join(sql.split())[:500])
+        if has_request_context() and 'query_count' in g:
+            g.query_count += 1
+            g.query_time += took
+
+    def render(self):
+        lines = []
+        for collector in self.collectors:
+            lines.extend(collector.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,84 @@
+import hmac, threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Hash formats werkzeug writes ("method$salt$hash"); anything else in the
+# password column is a legacy plaintext value.
+HASH_PREFIXES = ('scrypt:', 'pbkdf2:')
+
+
+class Busy(Exception):
+    """The verification queue is full; the caller should retry later."""
+
+
+def is_hashed(stored):
+    return stored.startswith(HASH_PREFIXES) and stored.count('$') == 2
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded thread pool.
+
+    hashlib's scrypt and PBKDF2 release the GIL, so ``max_workers`` threads
+    keep that many cores busy while request threads wait on the result. At
+    most ``max_pending`` checks are queued or running; past that ``Busy`` is
+    raised instead of letting a login storm tie up every request thread.
+    ``method`` is a werkzeug method string with its cost, e.g.
+    "scrypt:32768:8:1" or "pbkdf2:sha256:600000". Bulk hashing (imports)
+    runs on its own ``bulk_workers`` threads so logins never queue behind it.
+    """
+
+    def __init__(self, method='scrypt:32768:8:1', max_workers=2, max_pending=64, bulk_workers=1):
+        self.method = method
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='passwords')
+        self.bulk = ThreadPoolExecutor(max_workers=bulk_workers, thread_name_prefix='passwords-bulk')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self._dummy = None
+
+    def _run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise Busy()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        return future.result()
+
+    def dummy_hash(self):
+        if self._dummy is None:
+            self._dummy = generate_password_hash('', self.method)
+        return self._dummy
+
+    def needs_rehash(self, stored):
+        # Compare against a hash made now so "pbkdf2:sha256" matches its expanded default cost
+        return stored.split('$', 1)[0] != self.dummy_hash().split('$', 1)[0]
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def hash_many(self, passwords):
+        """Hash a batch (imports, migrations) on the bulk pool, apart from logins."""
+        return list(self.bulk.map(lambda p: generate_password_hash(p, self.method), passwords))
+
+    def check(self, stored, password):
+        """Return (ok, new_hash). ``new_hash`` is set when the password matched
+        a plaintext value or a hash of another method or cost. ``stored`` may
+        be None for an unknown user, which costs the same as a wrong password."""
+        return self._run(self._check, stored, password)
+
+    def _check(self, stored, password):
+        if stored is None:
+            check_password_hash(self.dummy_hash(), password)
+            return False, None
+        if is_hashed(stored):
+            ok = check_password_hash(stored, password)
+        else:
+            ok = hmac.compare_digest(stored.encode(), password.encode())
+        if ok and (not is_hashed(stored) or self.needs_rehash(stored)):
+            return True, generate_password_hash(password, self.method)
+        return ok, None
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        self.bulk.shutdown(wait=wait)
@@ -0,0 +1,182 @@
+import threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+import db
+
+
+class MemoryRateLimiter:
+    """Token buckets keyed by client: ``burst`` requests at once, refilled at
+    ``rate`` per second. Per process; the least recently seen keys are
+    dropped past ``maxsize``."""
+
+    def __init__(self, rate, burst, maxsize=100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (tokens, monotonic stamp)
+        self._lock = threading.Lock()
+
+    def hit(self, key, cost=1):
+        """Take ``cost`` tokens; returns 0 if allowed, else seconds until it would be."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0.0
+            else:
+                wait = (cost - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+
+class _BucketPool(db.ConnectionPool):
+    def connect(self):
+        conn = super().connect()
+        conn.execute("""CREATE TABLE IF NOT EXISTS buckets(
+                          key TEXT PRIMARY KEY, tokens REAL NOT NULL, stamp REAL NOT NULL) WITHOUT ROWID""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_buckets_stamp ON buckets(stamp)")
+        return conn
+
+
+class SQLiteRateLimiter:
+    """MemoryRateLimiter's buckets in a SQLite file, so every worker process
+    draws on the same ones. The file is separate from the voting database,
+    so checking a limit never waits behind ballot writes. Each limiter keeps
+    its keys under its own ``name`` prefix in the shared table. Its buckets
+    idle long enough to have refilled are purged every ``purge_interval``
+    seconds."""
+
+    def __init__(self, path, rate, burst, name='', pool_size=4, busy_timeout=1000, purge_interval=300):
+        self.prefix = name + '|'
+        self.rate = rate
+        self.burst = burst
+        self.purge_interval = purge_interval
+        # Losing the latest buckets in a crash only forgives a few requests
+        self.pool = _BucketPool(path, size=pool_size, busy_timeout=busy_timeout, synchronous='OFF')
+        self._last_purge = 0.0
+
+    def _key(self, key):
+        return self.prefix + (':'.join(map(str, key)) if isinstance(key, tuple) else str(key))
+
+    def hit(self, key, cost=1):
+        """Take ``cost`` tokens; returns 0 if allowed, else seconds until it would be."""
+        now, key = time.time(), self._key(key)
+        args = {'key': key, 'now': now, 'cost': cost, 'rate': self.rate, 'burst': self.burst}
+        conn = self.pool.acquire()
+        try:
+            with conn:
+                # One statement, so the refill and the take are atomic across processes
+                if conn.execute("""
+                    INSERT INTO buckets(key, tokens, stamp) SELECT :key, :burst - :cost, :now WHERE :burst >= :cost
+                    ON CONFLICT(key) DO UPDATE SET tokens = min(:burst, tokens + (:now - stamp) * :rate) - :cost,
+                                                   stamp = :now
+                    WHERE min(:burst, tokens + (:now - stamp) * :rate) >= :cost
+                    RETURNING tokens
+                """, args).fetchone():
+                    wait = 0.0
+                else:
+                    row = conn.execute("SELECT tokens, stamp FROM buckets WHERE key=?", (key,)).fetchone()
+                    tokens = min(self.burst, row[0] + (now - row[1]) * self.rate) if row else self.burst
+                    wait = (cost - tokens) / self.rate
+                if now - self._last_purge > self.purge_interval:
+                    self._last_purge = now
+                    # Only this limiter's keys: '}' sorts right after the '|' ending the prefix
+                    conn.execute("DELETE FROM buckets WHERE stamp < ? AND key >= ? AND key < ?",
+                                 (now - self.burst / self.rate, self.prefix, self.prefix[:-1] + '}'))
+        finally:
+            self.pool.release(conn)
+        return wait
+
+    def reset(self, key):
+        conn = self.pool.acquire()
+        try:
+            with conn:
+                conn.execute("DELETE FROM buckets WHERE key=?", (self._key(key),))
+        finally:
+            self.pool.release(conn)
+
+
+def from_config(app, name, rate, burst):
+    """A limiter for the configured backend; ``name`` keeps its shared buckets apart from other limiters'."""
+    if app.config.get('RATELIMIT_BACKEND', 'memory') == 'sqlite':
+        return SQLiteRateLimiter(app.config['RATELIMIT_DATABASE'], rate, burst, name=name)
+    return MemoryRateLimiter(rate, burst)
+
+
+class Overloaded(Exception):
+    """Raised by AdmissionControl.admit(); retry after ``retry_after`` seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class AdmissionControl:
+    """Bounds the database writes in flight and sheds the excess early.
+
+    At most ``concurrency`` callers are inside admit() at once; the rest
+    queue. The time each admitted write takes feeds a moving average, and a
+    caller whose predicted queueing delay (the writes ahead of it times that
+    average, over ``concurrency``) exceeds ``max_wait`` is refused with
+    Overloaded straight away, as is one still queued after ``max_wait``.
+    A request thread is never held longer than that waiting for the writer.
+    """
+
+    def __init__(self, concurrency=8, max_wait=1.0, alpha=0.2, initial_latency=0.01):
+        self.concurrency = concurrency
+        self.max_wait = max_wait
+        self.alpha = alpha
+        self.latency = initial_latency
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self._cond = threading.Condition()
+
+    def _drain_time(self):
+        return (self.running + self.waiting) * self.latency / self.concurrency
+
+    def _refuse(self):
+        self.shed += 1
+        return Overloaded(max(self._drain_time(), self.latency))
+
+    @contextmanager
+    def admit(self):
+        with self._cond:
+            if self.running >= self.concurrency:
+                if (self.waiting + 1) * self.latency / self.concurrency > self.max_wait:
+                    raise self._refuse()
+                self.waiting += 1
+                deadline = time.monotonic() + self.max_wait
+                try:
+                    while self.running >= self.concurrency:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise self._refuse()
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+            self.admitted += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._cond:
+                self.running -= 1
+                self.latency += self.alpha * (elapsed - self.latency)
+                self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {'running': self.running, 'waiting': self.waiting, 'admitted': self.admitted,
+                    'shed': self.shed, 'latency_seconds': round(self.latency, 6)}
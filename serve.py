@@ -0,0 +1,60 @@
+"""Run the site under a production WSGI server.
+
+    python serve.py --bind 0.0.0.0:8000 --workers 4 --threads 8
+
+Uses gunicorn when it is installed: the app is set up once in the master
+(preload), so migrations run a single time, then forked into ``--workers``
+processes with ``--threads`` threads each. Without gunicorn (e.g. on
+Windows) it falls back to waitress, then to werkzeug's threaded server,
+both single-process. See README.md for how many workers SQLite can take.
+"""
+import argparse, os
+
+from app import configure_app
+
+
+def serve_gunicorn(app, bind, workers, threads, timeout):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in {'bind': bind, 'workers': workers, 'threads': threads,
+                               'worker_class': 'gthread', 'preload_app': True, 'timeout': timeout}.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bind', default=os.environ.get('VOTING_BIND', '127.0.0.1:8000'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('VOTING_WORKERS', os.cpu_count() or 1)),
+                        help='worker processes (gunicorn only; default: CPU count)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('VOTING_THREADS', 8)),
+                        help='threads per worker')
+    parser.add_argument('--timeout', type=int, default=60, help='worker timeout in seconds (gunicorn only)')
+    args = parser.parse_args(argv)
+
+    app = configure_app()
+    host, _, port = args.bind.rpartition(':')
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        return serve_gunicorn(app, args.bind, args.workers, args.threads, args.timeout)
+    try:
+        from waitress import serve
+    except ImportError:
+        from werkzeug.serving import run_simple
+        app.logger.warning("neither gunicorn nor waitress is installed; using werkzeug's development server")
+        run_simple(host or '127.0.0.1', int(port), app, threaded=True)
+    else:
+        serve(app, host=host or '127.0.0.1', port=int(port), threads=args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+import secrets, threading, time
+from collections import OrderedDict
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+import db
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data kept on the server; the cookie only carries a random id."""
+
+    def __init__(self, initial=None, sid=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.modified = False
+        self.rotate = False
+
+    def regenerate(self):
+        """Move the session to a fresh id on the next save (call on login)."""
+        self.rotate = True
+        self.modified = True
+
+
+class MemorySessionStore:
+    """Sessions in this process's memory, evicted least-recently-used past
+    ``maxsize``. Lost on restart and not shared between worker processes."""
+
+    def __init__(self, idle_timeout=1800, maxsize=10000):
+        self.idle_timeout = idle_timeout
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # sid -> [expires, user_id, data]
+        self._by_user = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _drop(self, sid):
+        entry = self._data.pop(sid, None)
+        if entry is not None and entry[1] is not None:
+            sids = self._by_user.get(entry[1])
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._by_user[entry[1]]
+
+    def load(self, sid):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(sid)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                self._drop(sid)
+                return None
+            entry[0] = now + self.idle_timeout
+            self._data.move_to_end(sid)
+            return dict(entry[2])
+
+    def save(self, sid, data, user_id, new=True):
+        now = time.time()
+        with self._lock:
+            if not new and sid not in self._data:
+                return  # revoked or expired while the request ran
+            self._drop(sid)
+            self._data[sid] = [now + self.idle_timeout, user_id, dict(data)]
+            if user_id is not None:
+                self._by_user.setdefault(user_id, set()).add(sid)
+            # Oldest first: expired entries and, past maxsize, the least recently used
+            while self._data:
+                oldest, entry = next(iter(self._data.items()))
+                if entry[0] > now and len(self._data) <= self.maxsize:
+                    break
+                if entry[0] > now:
+                    self.evictions += 1
+                self._drop(oldest)
+
+    def delete(self, sid):
+        with self._lock:
+            self._drop(sid)
+
+    def update_user(self, user_id, **fields):
+        with self._lock:
+            for sid in self._by_user.get(user_id, ()):
+                self._data[sid][2].update(fields)
+
+    def revoke_user(self, user_id):
+        with self._lock:
+            sids = list(self._by_user.get(user_id, ()))
+            for sid in sids:
+                self._drop(sid)
+        return len(sids)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'evictions': self.evictions}
+
+
+class _SessionPool(db.ConnectionPool):
+    def connect(self):
+        conn = super().connect()
+        conn.execute("""CREATE TABLE IF NOT EXISTS sessions(
+                          sid TEXT PRIMARY KEY, user_id INTEGER, data TEXT NOT NULL, expires REAL NOT NULL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires)")
+        return conn
+
+
+class SQLiteSessionStore:
+    """Sessions in a SQLite file of their own, shared by every worker process.
+    Kept apart from the voting database so session writes (every flash()
+    is one) never queue behind ballots for its write lock.
+
+    Loading a session only writes back its new expiry once ``touch_interval``
+    seconds have passed, so most requests cost one primary-key read.
+    """
+
+    def __init__(self, path, idle_timeout=1800, touch_interval=60, purge_interval=300,
+                 pool_size=8, busy_timeout=5000):
+        self.pool = _SessionPool(path, size=pool_size, busy_timeout=busy_timeout)
+        self.idle_timeout = idle_timeout
+        self.touch_interval = touch_interval
+        self.purge_interval = purge_interval
+        self.serializer = TaggedJSONSerializer()
+        self._last_purge = 0.0
+
+    def _run(self, fn):
+        conn = self.pool.acquire()
+        try:
+            with conn:
+                return fn(conn)
+        finally:
+            self.pool.release(conn)
+
+    def load(self, sid):
+        now = time.time()
+
+        def load(conn):
+            row = conn.execute("SELECT data, expires FROM sessions WHERE sid=?", (sid,)).fetchone()
+            if row is None or row[1] <= now:
+                return None
+            if row[1] - now < self.idle_timeout - self.touch_interval:
+                conn.execute("UPDATE sessions SET expires=? WHERE sid=?", (now + self.idle_timeout, sid))
+            return self.serializer.loads(row[0])
+        return self._run(load)
+
+    def save(self, sid, data, user_id, new=True):
+        """Store a session; an existing one (``new`` False) is only updated, so
+        one revoked while its request was running stays revoked."""
+        now = time.time()
+
+        def save(conn):
+            args = (user_id, self.serializer.dumps(dict(data)), now + self.idle_timeout, sid)
+            if new:
+                conn.execute("INSERT INTO sessions(user_id, data, expires, sid) VALUES(?,?,?,?)", args)
+            else:
+                conn.execute("UPDATE sessions SET user_id=?, data=?, expires=? WHERE sid=?", args)
+            if now - self._last_purge > self.purge_interval:
+                self._last_purge = now
+                conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+        self._run(save)
+
+    def delete(self, sid):
+        self._run(lambda conn: conn.execute("DELETE FROM sessions WHERE sid=?", (sid,)))
+
+    def update_user(self, user_id, **fields):
+        def update(conn):
+            rows = conn.execute("SELECT sid, data FROM sessions WHERE user_id=?", (user_id,)).fetchall()
+            conn.executemany("UPDATE sessions SET data=? WHERE sid=?",
+                             [(self.serializer.dumps({**self.serializer.loads(data), **fields}), sid)
+                              for sid, data in rows])
+        self._run(update)
+
+    def revoke_user(self, user_id):
+        return self._run(lambda conn: conn.execute("DELETE FROM sessions WHERE user_id=?", (user_id,)).rowcount)
+
+    def stats(self):
+        return {'size': self._run(lambda conn: conn.execute(
+            "SELECT COUNT(*) FROM sessions WHERE expires > ?", (time.time(),)).fetchone()[0])}
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain, path = self.get_cookie_domain(app), self.get_cookie_path(app)
+        if not session:
+            if session.sid and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        if session.rotate and session.sid:
+            self.store.delete(session.sid)
+            session.sid = None
+        sid = session.sid or secrets.token_urlsafe(32)
+        self.store.save(sid, session, session.get('user_id'), new=sid != session.sid)
+        if sid != session.sid:
+            response.set_cookie(name, sid, domain=domain, path=path,
+                                httponly=self.get_cookie_httponly(app),
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+        response.vary.add('Cookie')
+
+
+def from_config(app):
+    if app.config.get('SESSION_BACKEND', 'sqlite') == 'memory':
+        return MemorySessionStore(idle_timeout=app.config['SESSION_IDLE_TIMEOUT'],
+                                  maxsize=app.config['SESSION_MAX_ENTRIES'])
+    return SQLiteSessionStore(app.config['SESSION_DATABASE'], idle_timeout=app.config['SESSION_IDLE_TIMEOUT'],
+                              pool_size=app.config['DB_POOL_SIZE'], busy_timeout=app.config['DB_BUSY_TIMEOUT_MS'])
@@ -0,0 +1,223 @@
+import os, sqlite3, threading
+from collections import OrderedDict
+from flask import g
+import db
+
+# A shard holds one election's votes and tallies under the same names and
+# shapes as the main database, so record_vote(), check_tallies() and the
+# result/export queries run unchanged on a shard connection.
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS votes (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER,
+      candidate_id INTEGER,
+      election_id INTEGER,
+      ranks BLOB
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_votes_user_election ON votes(user_id, election_id)",
+    "CREATE INDEX IF NOT EXISTS idx_votes_candidate ON votes(candidate_id)",
+    """CREATE TABLE IF NOT EXISTS tallies (
+      election_id INTEGER NOT NULL,
+      candidate_id INTEGER NOT NULL,
+      count INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY(election_id, candidate_id)
+    ) WITHOUT ROWID""",
+    # The election's ballot ledger (ledger.py), laid out as in the main database
+    """CREATE TABLE IF NOT EXISTS ledger (
+      election_id INTEGER NOT NULL,
+      seq INTEGER NOT NULL,
+      kind TEXT NOT NULL,
+      vote_id INTEGER NOT NULL,
+      user_id INTEGER,
+      candidate_id INTEGER,
+      ranks BLOB,
+      leaf BLOB NOT NULL,
+      PRIMARY KEY(election_id, seq)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_ledger_vote ON ledger(election_id, vote_id)",
+    """CREATE TABLE IF NOT EXISTS ledger_nodes (
+      election_id INTEGER NOT NULL,
+      level INTEGER NOT NULL,
+      idx INTEGER NOT NULL,
+      hash BLOB NOT NULL,
+      PRIMARY KEY(election_id, level, idx)
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+      election_id INTEGER NOT NULL,
+      size INTEGER NOT NULL,
+      root BLOB NOT NULL,
+      frontier BLOB NOT NULL,
+      created REAL NOT NULL,
+      PRIMARY KEY(election_id, size)
+    ) WITHOUT ROWID""",
+) + tuple(
+    # A shard is removed as a whole, so its ledger rows never change or go
+    f"""CREATE TRIGGER IF NOT EXISTS {table}_no_{op} BEFORE {op.upper()} ON {table}
+    BEGIN SELECT RAISE(ABORT, 'the ballot ledger is append-only'); END"""
+    for table in ('ledger', 'ledger_nodes', 'ledger_checkpoints') for op in ('update', 'delete')
+)
+
+
+class ShardPool(db.ConnectionPool):
+    """Connections whose main database is a shard file, with the main voting
+    database attached as ``core``.
+
+    Unqualified names resolve to the shard first, so ``votes`` and
+    ``tallies`` are the election's own while ``candidates``, ``elections``
+    and ``users`` fall through to core. A deferred transaction that only
+    writes shard tables locks only the shard file; BEGIN IMMEDIATE would
+    lock core as well, so never use it on these connections.
+
+    Checked-out connections are counted so that a retired pool (evicted or
+    dropped) closes only once the last of them is released.
+    """
+
+    def __init__(self, path, core_path, **kwargs):
+        # The file is made by VoteShards.create(); reopening a dropped shard must fail
+        super().__init__(path, create=False, **kwargs)
+        self.core_path = core_path
+        self.busy = 0
+        self.retired = False
+        self._on_close = []
+        self._busy_lock = threading.Lock()
+
+    def connect(self):
+        conn = super().connect()
+        for statement in SCHEMA:
+            conn.execute(statement)
+        # Shards created before ranked ballots existed
+        if 'ranks' not in {row[1] for row in conn.execute("PRAGMA table_info(votes)")}:
+            conn.execute("ALTER TABLE votes ADD COLUMN ranks BLOB")
+        conn.execute("ATTACH DATABASE ? AS core", (self.core_path,))
+        return conn
+
+    def acquire(self):
+        conn = super().acquire()
+        with self._busy_lock:
+            self.busy += 1
+        return conn
+
+    def release(self, conn):
+        with self._busy_lock:
+            self.busy -= 1
+            retired = self.retired
+        if retired:
+            conn.close()
+        else:
+            super().release(conn)
+        self._close_if_idle()
+
+    def retire(self, then=None):
+        """Close the pool as soon as no connection is checked out, then call ``then``."""
+        with self._busy_lock:
+            self.retired = True
+            if then is not None:
+                self._on_close.append(then)
+        self._close_if_idle()
+
+    def _close_if_idle(self):
+        with self._busy_lock:
+            if not self.retired or self.busy:
+                return
+            callbacks, self._on_close = self._on_close, []
+        self.close()
+        for then in callbacks:
+            then()
+
+
+class VoteShards:
+    """Routes an election's ballots to ``folder/election_<id>.db``.
+
+    Pools for the ``max_open`` most recently used shards stay open; older
+    ones are closed once idle and reopened on demand.
+    """
+
+    def __init__(self, app, folder, pool_size=4, max_open=32):
+        self.app = app
+        self.folder = folder
+        self.pool_size = pool_size
+        self.max_open = max_open
+        self._pools = OrderedDict()
+        self._draining = {}  # election_id -> evicted pools still in use
+        self._lock = threading.Lock()
+        app.teardown_appcontext(self.release)
+
+    def path(self, election_id):
+        return os.path.join(self.folder, f"election_{int(election_id)}.db")
+
+    def create(self, election_id):
+        """Make an election's shard file; pools only open files that exist."""
+        os.makedirs(self.folder, exist_ok=True)
+        sqlite3.connect(self.path(election_id)).close()
+
+    def pool(self, election_id):
+        evicted = []
+        with self._lock:
+            pool = self._pools.get(election_id)
+            if pool is None:
+                pool = self._pools[election_id] = ShardPool(
+                    self.path(election_id), os.path.abspath(self.app.config['DATABASE']),
+                    size=self.pool_size, busy_timeout=self.app.config['DB_BUSY_TIMEOUT_MS'],
+                    synchronous=self.app.config['DB_SYNCHRONOUS'])
+                while len(self._pools) > self.max_open:
+                    old_id, old = self._pools.popitem(last=False)
+                    self._draining.setdefault(old_id, set()).add(old)
+                    evicted.append((old_id, old))
+            self._pools.move_to_end(election_id)
+        for old_id, old in evicted:
+            old.retire(lambda old_id=old_id, old=old: self._drained(old_id, old))
+        return pool
+
+    def _drained(self, election_id, pool):
+        with self._lock:
+            pools = self._draining.get(election_id)
+            if pools is not None:
+                pools.discard(pool)
+                if not pools:
+                    del self._draining[election_id]
+
+    def get_db(self, election_id):
+        """The request's connection to this election's shard, released at teardown."""
+        conns = g.setdefault('shard_conns', {})
+        if election_id not in conns:
+            pool = self.pool(election_id)
+            conns[election_id] = (pool, pool.acquire())
+        return conns[election_id][1]
+
+    def release(self, exc=None):
+        for pool, conn in g.pop('shard_conns', {}).values():
+            pool.release(conn)
+
+    def drop(self, election_id):
+        """Delete an election's ballots by removing its shard file, once every
+        connection to it has been released."""
+        with self._lock:
+            pools = set(self._draining.pop(election_id, ()))
+            if election_id in self._pools:
+                pools.add(self._pools.pop(election_id))
+        if not pools:
+            return self._unlink(election_id)
+        remaining = [len(pools)]
+        lock = threading.Lock()
+
+        def closed():
+            with lock:
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last:
+                self._unlink(election_id)
+        for pool in pools:
+            pool.retire(closed)
+
+    def _unlink(self, election_id):
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.path(election_id) + suffix)
+            except FileNotFoundError:
+                pass
+
+    def election_ids(self):
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(int(f[9:-3]) for f in os.listdir(self.folder)
+                      if f.startswith('election_') and f.endswith('.db') and f[9:-3].isdigit())
@@ -0,0 +1,31 @@
+// Live tallies on the results page: counts are pushed by the server as votes come in.
+(function () {
+    var source = new EventSource(document.currentScript.getAttribute('data-stream'));
+    function apply(counts, full) {
+        var table = document.getElementById('result-table');
+        if (!table) { location.reload(); return; }
+        var rows = table.querySelectorAll('tr[data-candidate]');
+        var seen = {};
+        rows.forEach(function (row) {
+            var name = row.getAttribute('data-candidate');
+            if (name in counts) {
+                seen[name] = true;
+                row.querySelector('.vote-count').textContent = counts[name];
+                row.style.display = counts[name] > 0 ? '' : 'none';
+            } else if (full) {
+                row.style.display = 'none';
+            }
+        });
+        Object.keys(counts).forEach(function (name) {
+            if (seen[name] || counts[name] <= 0) return;
+            var row = table.insertRow(-1);
+            row.setAttribute('data-candidate', name);
+            row.insertCell(0).textContent = name;
+            var cell = row.insertCell(1);
+            cell.className = 'vote-count';
+            cell.textContent = counts[name];
+        });
+    }
+    source.addEventListener('snapshot', function (e) { apply(JSON.parse(e.data), true); });
+    source.addEventListener('delta', function (e) { apply(JSON.parse(e.data), false); });
+})();
@@ -0,0 +1,98 @@
+import hashlib, mimetypes, os, re, tempfile
+
+# Blobs are addressed by the SHA-256 of their content: "ab/cd/abcd...ef.png".
+KEY_RE = re.compile(r'^([0-9a-f]{2})/([0-9a-f]{2})/([0-9a-f]{64})\.([a-z0-9]{1,5})$')
+
+
+def make_key(data, ext):
+    h = hashlib.sha256(data).hexdigest()
+    return f"{h[:2]}/{h[2:4]}/{h}.{ext.lower().lstrip('.')}"
+
+
+def is_key(value):
+    return bool(value) and KEY_RE.match(value) is not None
+
+
+def key_hash(key):
+    return KEY_RE.match(key).group(3)
+
+
+def key_mimetype(key):
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+
+class LocalStorage:
+    """Content-addressed blobs in sharded subdirectories of ``root``.
+
+    Writing the same bytes twice stores them once.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def put(self, data, ext):
+        key = make_key(data, ext)
+        path = self.local_path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return key
+
+    def get(self, key):
+        with open(self.local_path(key), 'rb') as f:
+            return f.read()
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage:
+    """The same interface on an S3-compatible bucket (AWS, MinIO, ...); needs boto3."""
+
+    def __init__(self, bucket, endpoint_url=None, prefix='uploads/'):
+        import boto3
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def local_path(self, key):
+        return None
+
+    def put(self, data, ext):
+        key = make_key(data, ext)
+        if not self.exists(key):
+            self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data,
+                                   ContentType=key_mimetype(key))
+        return key
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except ClientError:
+            return False
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+
+def from_config(config):
+    if config.get('STORAGE_BACKEND', 'local') == 's3':
+        return S3Storage(config['S3_BUCKET'], endpoint_url=config.get('S3_ENDPOINT_URL'))
+    return LocalStorage(config['BLOB_FOLDER'])
@@ -0,0 +1,155 @@
+import numpy as np
+
+# Counting methods an election can use. Plurality ballots are a single
+# candidate_id; the others also keep the voter's marks in votes.ranks as
+# little-endian int32 candidate ids, most preferred first (approval ballots
+# in the order the candidates were listed).
+METHODS = {
+    'plurality': 'Plurality',
+    'irv': 'Instant runoff',
+    'stv': 'Single transferable vote',
+    'approval': 'Approval',
+}
+RANKED = ('irv', 'stv')
+
+
+def encode(candidate_ids):
+    return np.asarray(candidate_ids, '<i4').tobytes()
+
+
+def decode(blob):
+    return np.frombuffer(blob, '<i4').tolist()
+
+
+def from_blobs(blobs):
+    """(lengths, flat) arrays from an iterable of encoded ballots."""
+    blobs = list(blobs)
+    lengths = np.fromiter(map(len, blobs), np.int64, len(blobs)) // 4
+    return lengths, np.frombuffer(b''.join(blobs), '<i4')
+
+
+def ballot_matrix(lengths, flat, candidate_ids):
+    """Ballots as an (n, width + 1) matrix of candidate positions.
+
+    Position ``k`` (the number of candidates) pads short ballots, stands in
+    for marks naming a candidate that no longer exists, and fills the last
+    column, so every row ends in it.
+    """
+    lengths = np.asarray(lengths, np.int64)
+    flat = np.asarray(flat, np.int64)
+    ids = np.asarray(candidate_ids, np.int64)
+    k = len(ids)
+    order = np.argsort(ids)
+    at = np.minimum(np.searchsorted(ids[order], flat), max(k - 1, 0))
+    mapped = np.where(ids[order][at] == flat, order[at], k) if k else np.zeros(len(flat), np.int64)
+    width = int(lengths.max()) if len(lengths) else 0
+    matrix = np.full((len(lengths), width + 1), k, np.int16 if k < 2**15 - 1 else np.int32)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    matrix[rows, cols] = mapped
+    return matrix
+
+
+def _next_hopeful(matrix, rows, start, hopeful):
+    """For each ballot in ``rows``, the first column at or after ``start`` that
+    names a hopeful candidate (the padding column when there is none)."""
+    sub = matrix[rows]
+    ok = hopeful[sub] & (np.arange(sub.shape[1]) >= start[:, None])
+    return np.where(ok.any(axis=1), ok.argmax(axis=1), sub.shape[1] - 1)
+
+
+def _ranked(cands, history):
+    """``cands`` from lowest to highest: by this round's count, ties broken by
+    the most recent earlier round that separates them, then by listing order
+    (the later-listed candidate ranks lower)."""
+    keys = [-cands] + [np.round(h[cands], 9) for h in history]
+    return cands[np.lexsort(keys)]
+
+
+def _transfer_rounds(matrix, k, seats, majority):
+    n = len(matrix)
+    hopeful = np.ones(k + 1, bool)
+    hopeful[k] = False
+    excluded = np.zeros(k, bool)
+    rows = np.arange(n)
+    pos = _next_hopeful(matrix, rows, np.zeros(n, np.int64), hopeful)
+    top = matrix[rows, pos].astype(np.int64)
+    weight = np.ones(n)
+    kept = np.zeros(k)  # votes that stay with candidates already elected
+    quota = None if majority else int(np.count_nonzero(top != k)) // (seats + 1) + 1
+    elected, rounds, history = [], [], []
+    while True:
+        tally = np.bincount(top, weights=weight, minlength=k + 1)
+        counts = tally[:k] + kept
+        history.append(counts)
+        standing = np.flatnonzero(hopeful[:k])
+        q = int(counts[standing].sum()) // 2 + 1 if majority else quota
+        rnd = {'counts': np.where(excluded, np.nan, counts), 'exhausted': tally[k],
+               'quota': q, 'elected': [], 'eliminated': []}
+        rounds.append(rnd)
+        need = seats - len(elected)
+        if len(standing) <= need:
+            # Everyone still standing fills the remaining seats
+            rnd['elected'] = _ranked(standing, history)[::-1].tolist()
+            elected += rnd['elected']
+            break
+        won = _ranked(standing[counts[standing] >= q], history)[::-1][:need]
+        if len(won):
+            rnd['elected'] = won.tolist()
+            elected += rnd['elected']
+            hopeful[won] = False
+            if len(elected) == seats:
+                break
+            moved = np.flatnonzero(np.isin(top, won))
+            # Fractional (Gregory) transfer: every ballot on a winner carries on
+            # at the share of its value that the surplus represents
+            ratio = np.zeros(k + 1)
+            ratio[won] = (counts[won] - q) / counts[won]
+            weight[moved] *= ratio[top[moved]]
+            kept[won] = q
+        else:
+            loser = _ranked(standing, history)[0]
+            rnd['eliminated'] = [int(loser)]
+            hopeful[loser] = False
+            excluded[loser] = True
+            moved = np.flatnonzero(top == loser)
+        pos[moved] = _next_hopeful(matrix, moved, pos[moved] + 1, hopeful)
+        top[moved] = matrix[moved, pos[moved]]
+    return rounds, elected, quota
+
+
+def _clean(values):
+    return [None if np.isnan(v) else int(v) if v == int(v) else float(v)
+            for v in np.round(np.asarray(values, float), 2)]
+
+
+def tabulate(method, candidate_ids, lengths, flat, seats=1):
+    """Count an election's ballots.
+
+    ``lengths`` and ``flat`` are the ballots as from_blobs() returns them.
+    Returns a dict whose ``rounds`` each hold per-candidate ``counts`` (in
+    ``candidate_ids`` order, None once a candidate is eliminated), the votes
+    ``exhausted`` so far, the ``quota`` and the positions ``elected`` and
+    ``eliminated`` in that round; ``elected`` lists every winner's position.
+    IRV runs until one candidate holds a majority of the votes still in
+    play; STV uses the Droop quota and transfers surpluses fractionally.
+    """
+    if method not in METHODS:
+        raise ValueError(f"unknown counting method {method!r}")
+    k = len(candidate_ids)
+    seats = 1 if method in ('plurality', 'irv') else max(1, min(int(seats), k))
+    matrix = ballot_matrix(lengths, flat, candidate_ids)
+    ballots = int(np.count_nonzero((matrix < k).any(axis=1)))
+    if method in RANKED:
+        rounds, elected, quota = _transfer_rounds(matrix, k, seats, majority=method == 'irv')
+    else:
+        marks = matrix[:, 0] if method == 'plurality' else matrix[matrix < k]
+        counts = np.bincount(marks, minlength=k + 1)[:k].astype(float)
+        elected = _ranked(np.arange(k), [counts])[::-1][:seats].tolist()
+        rounds = [{'counts': counts, 'exhausted': 0, 'quota': None, 'elected': elected, 'eliminated': []}]
+        quota = None
+    for rnd in rounds:
+        rnd['counts'] = _clean(rnd['counts'])
+        rnd['exhausted'] = _clean([rnd['exhausted']])[0]
+    return {'method': method, 'seats': seats, 'ballots': ballots, 'quota': quota,
+            'rounds': rounds, 'elected': elected}
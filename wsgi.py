@@ -0,0 +1,4 @@
+"""WSGI entry point: ``gunicorn wsgi:app`` or ``flask --app wsgi <command>``."""
+from app import configure_app
+
+app = configure_app()